@@ -0,0 +1,468 @@
+"""
+Asynchronous (ASGI) serving mode of the Trivia API.
+
+    uvicorn --factory async_api:create_app --workers 4
+
+Serves the question, category, search and quiz routes of flaskr with the
+same JSON contracts, on asyncpg (PostgreSQL) or aiosqlite (SQLite) instead
+of the SQLAlchemy session. The Flask app in flaskr stays the reference
+implementation and keeps the bulk, metrics and CLI features.
+"""
+import logging
+
+from decouple import config
+from flask import abort
+from sqlalchemy import func
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Query
+from werkzeug.exceptions import HTTPException, InternalServerError, NotFound
+
+from models import database_path, data_versions, bump_version, content_hash, \
+                   Question, change_log_statements, CHANGE_LOG_RETENTION, \
+                   CHANGE_LOG_LAST, \
+                   STATS_UPSERT, stats_rows, question_listeners, \
+                   notify_questions
+from flaskr import QUESTIONS_PER_PAGE, MAX_QUESTIONS_PER_PAGE, \
+                   CATEGORY_SORT_COLUMNS
+from flaskr.categories import CategoryCache
+from flaskr.changes import ChangeFeed
+from flaskr.pagination import get_page_size, page_query, page_rows
+from flaskr.quiz import QuestionPool, dump_seen_token, parse_quiz_request
+from flaskr.search import InvertedIndexBackend, PostgresBackend, \
+                          parse_search_term, tokenize
+from flaskr.validation import validate_question, MAX_ID
+from flaskr.serialization import get_encoder, encode_rows, parse_fields, \
+                                 with_columns, QUESTION_COLUMNS
+from .database import Database
+from .http import Request, Router, error_body, encode_json, send_response
+
+logger = logging.getLogger(__name__)
+
+
+def format_question(row):
+  question_id, question, answer, category, difficulty = row
+  return {
+    'id': question_id,
+    'question': question,
+    'answer': answer,
+    'category': category,
+    'difficulty': difficulty
+  }
+
+
+class AsyncApp:
+  """
+  A minimal ASGI application: routes requests to async handlers and
+  turns HTTP errors into the JSON bodies of the flaskr error handlers.
+  Any other exception is logged and answered with a JSON 500.
+  """
+
+  def __init__(self, config, database):
+    self.config = config
+    self.db = database
+    self.router = Router()
+    self.route = self.router.route
+    self.startup = []
+    self.before_request = []
+    self.encoder = get_encoder(config['JSON_BACKEND'])
+
+  async def __call__(self, scope, receive, send):
+    if scope['type'] == 'lifespan':
+      await self.lifespan(receive, send)
+      return
+    if scope['type'] != 'http':
+      return
+    body = b''
+    more_body = True
+    while more_body:
+      message = await receive()
+      body += message.get('body', b'')
+      more_body = message.get('more_body', False)
+    request = Request(scope, body)
+    try:
+      await self.start()
+      for hook in self.before_request:
+        await hook()
+      if request.method == 'OPTIONS':
+        # CORS preflight, answered for every routed path
+        if not self.router.methods(request.path):
+          raise NotFound()
+        await send_response(send, 200, b'', b'text/html; charset=utf-8')
+        return
+      handler, arguments = self.router.match(request.method, request.path)
+      status, data = 200, await handler(request, **arguments)
+    except HTTPException as error:
+      status, data = error_body(error)
+    except Exception:
+      logger.exception('%s %s failed', request.method, request.path)
+      status, data = error_body(InternalServerError())
+    await send_response(send, status, encode_json(data, self.encoder))
+
+  async def start(self):
+    if self.db.pool is None:
+      await self.db.connect()
+      for hook in self.startup:
+        await hook()
+
+  async def close(self):
+    await self.db.close()
+
+  async def lifespan(self, receive, send):
+    while True:
+      message = await receive()
+      if message['type'] == 'lifespan.startup':
+        await self.start()
+        await send({'type': 'lifespan.startup.complete'})
+      elif message['type'] == 'lifespan.shutdown':
+        await self.close()
+        await send({'type': 'lifespan.shutdown.complete'})
+        return
+
+
+def create_app(test_config=None):
+  # same settings and defaults as flaskr.create_app
+  settings = {
+    'QUESTIONS_PER_PAGE': QUESTIONS_PER_PAGE,
+    'MAX_QUESTIONS_PER_PAGE': MAX_QUESTIONS_PER_PAGE,
+    'SECRET_KEY': config('SECRET_KEY', default='dev'),
+    'DB_POOL_SIZE': 5,
+    'DB_MAX_OVERFLOW': 10,
+    'DB_STATEMENT_TIMEOUT': None,
+    'JSON_BACKEND': 'auto',
+    'CHANGE_LOG_RETENTION': CHANGE_LOG_RETENTION,
+    'CHANGES_SYNC_INTERVAL': 1.0,
+    'SQLALCHEMY_DATABASE_URI': database_path
+  }
+  if test_config is not None:
+    settings.update(test_config)
+  database = Database(settings['SQLALCHEMY_DATABASE_URI'],
+                      settings['DB_POOL_SIZE'] + settings['DB_MAX_OVERFLOW'],
+                      settings['DB_STATEMENT_TIMEOUT'])
+  app = AsyncApp(settings, database)
+  db = app.db
+  categories = CategoryCache()
+  question_pool = QuestionPool()
+  question_listeners.add(question_pool)
+  question_counts = {}
+  # only syncs the data versions with the change log, nobody waits on it
+  changes = ChangeFeed(None, settings['CHANGES_SYNC_INTERVAL'])
+  if db.dialect == 'postgresql':
+    search = PostgresBackend()
+  else:
+    search = InvertedIndexBackend()
+  # queries are built with the SQLAlchemy helpers of flaskr, then compiled
+  # with :name parameters for the async driver
+  dialect = (postgresql if db.dialect == 'postgresql' else sqlite)\
+            .dialect(paramstyle='named')
+
+  async def sync_versions():
+    # writes of other worker processes invalidate the caches of this one
+    if changes.sync_due():
+      changes.observe(await db.scalar(CHANGE_LOG_LAST))
+  app.before_request.append(sync_versions)
+
+  async def fetch_query(query):
+    compiled = query.statement.compile(dialect=dialect)
+    return await db.fetch(str(compiled), compiled.params)
+
+  # the caches of flaskr are shared as is: they are loaded here with rows
+  # of the async driver, so their refresh() finds them up to date
+  async def fresh_categories():
+    while categories.version != data_versions['categories']:
+      version = data_versions['categories']
+      categories.load(await db.fetch('SELECT id, type FROM categories'),
+                      version)
+    return categories
+
+  async def fresh_question_pool():
+    while question_pool.version != data_versions['questions']:
+      version = data_versions['questions']
+      question_pool.load(await db.fetch('SELECT id, category FROM questions'),
+                         version)
+    return question_pool
+
+  async def fresh_search_index():
+    while search.version != data_versions['questions']:
+      version = data_versions['questions']
+      search.load(await db.fetch('SELECT id, question, answer, category '
+                                 'FROM questions'), version)
+    return search
+
+  async def count_questions():
+    version = data_versions['questions']
+    if version not in question_counts:
+      total = await db.scalar('SELECT count(id) FROM questions')
+      question_counts.clear()
+      question_counts[version] = total
+    return question_counts[version]
+
+  async def record_question_changes(session, changes):
+    # runs the statements of models.record_question_changes, returns the
+    # last seq before and after the write
+    statements = change_log_statements(changes, db.dialect,
+                                       settings['CHANGE_LOG_RETENTION'])
+    value = None
+    try:
+      while True:
+        statement, params = statements.send(value)
+        value = await session.scalar(statement, params)
+    except StopIteration as done:
+      return done.value
+
+  async def update_question_stats(session, questions, sign):
+    # same counters as models.update_question_stats
+    for row in stats_rows(questions, sign):
+      await session.execute(STATS_UPSERT, row)
+
+  def get_fields(request):
+    try:
+      return parse_fields(request.args.get('fields', None))
+    except ValueError as error:
+      abort(400, str(error))
+
+  async def paginate(request, criteria=(), sort_column=None,
+                     descending=False, fields=QUESTION_COLUMNS):
+    """
+    This function fetches one page of questions with flaskr's page_query.
+    Returns the rows and the cursor of the next page.
+    """
+    columns = [Question.id] if sort_column is None \
+              else [sort_column, Question.id]
+    selected = with_columns(fields, *columns)
+    query, per_page = page_query(Query(selected).filter(*criteria),
+                                 Question.id, sort_column, descending,
+                                 request.args, settings)
+    # the cursor of the next page is read from the sort columns
+    keys = [column.key for column in selected]
+    positions = [keys.index(column.key) for column in columns]
+    return page_rows(await fetch_query(query), per_page,
+                     lambda row: [row[position] for position in positions])
+
+  async def load_questions(ids, fields=QUESTION_COLUMNS):
+    # like flaskr.search.load_questions: rows of `fields`, in `ids` order
+    if not ids:
+      return []
+    selected = with_columns(fields, Question.id)
+    rows = await fetch_query(Query(selected).filter(Question.id.in_(ids)))
+    key = [column.key for column in selected].index('id')
+    questions = {row[key]: row for row in rows}
+    return [questions[question_id] for question_id in ids
+            if question_id in questions]
+
+  @app.route('/categories', methods=['GET'])
+  async def get_categories(request):
+    """
+    This function handles requesting all availabe categories.
+    """
+    formatted_categories = (await fresh_categories()).all()
+    if not len(formatted_categories):
+      abort(404)
+
+    return {
+      'success': True,
+      'categories': formatted_categories,
+      'total_categories': len(formatted_categories)
+    }
+
+  @app.route('/questions', methods=['GET'])
+  async def get_questions(request):
+    """
+    This function handles requests for paginated questions.
+    """
+    fields = get_fields(request)
+    questions, next_cursor = await paginate(request, fields=fields)
+    if len(questions) == 0:
+      abort(404)
+    formatted_questions = encode_rows(questions, fields)
+
+    total_questions = await count_questions()
+    return {
+      'success': True,
+      'questions': formatted_questions,
+      'total_questions': total_questions,
+      'next_cursor': next_cursor,
+      'categories': (await fresh_categories()).all(),
+      'currentCategory': None
+    }
+
+  @app.route('/questions/<int:question_id>', methods=['DELETE'])
+  async def delete_question(request, question_id):
+    """
+    This function handles deleting requested question.
+    """
+    # no stored question can have a larger id
+    if question_id > MAX_ID:
+      abort(404)
+    async with db.transaction() as session:
+      # RETURNING needs PostgreSQL or SQLite 3.35+
+      deleted = await session.fetch('DELETE FROM questions WHERE id = :id '
+                                    'RETURNING category, difficulty',
+                                    {'id': question_id})
+      if deleted:
+        change_log = await record_question_changes(
+          session, [('delete', {'id': question_id})])
+        await update_question_stats(session, deleted, -1)
+    if not deleted:
+      abort(404)
+    changes.adopt(*change_log)
+    bump_version('questions')
+    notify_questions([('delete', {'id': question_id})])
+
+    return {
+      'success': True
+    }
+
+  @app.route('/questions', methods=['POST'])
+  async def add_question(request):
+    """
+    This function handles inserting a new question.
+    """
+    data = request.get_json()
+    try:
+      values = validate_question(data, await fresh_categories())
+    except ValueError as error:
+      abort(400, str(error))
+
+    fields = ('question', 'answer', 'category', 'difficulty', 'content_hash')
+    params = dict(zip(fields, tuple(values) + (content_hash(*values[:2]),)))
+    async with db.transaction() as session:
+      # a duplicate is skipped by the unique content_hash index;
+      # RETURNING needs PostgreSQL or SQLite 3.35+
+      question_id = await session.scalar(
+        'INSERT INTO questions '
+        '(question, answer, category, difficulty, content_hash) '
+        'VALUES (:question, :answer, :category, :difficulty, :content_hash) '
+        'ON CONFLICT (content_hash) DO NOTHING RETURNING id', params)
+      if question_id is not None:
+        question = format_question((question_id,) + tuple(values))
+        change_log = await record_question_changes(session,
+                                                   [('insert', question)])
+        await update_question_stats(session, [values[2:4]], 1)
+    duplicate = question_id is None
+    if duplicate:
+      question_id = await db.scalar(
+        'SELECT id FROM questions WHERE content_hash = :content_hash',
+        {'content_hash': params['content_hash']})
+    else:
+      changes.adopt(*change_log)
+      bump_version('questions')
+      notify_questions([('insert', question)])
+
+    return {
+      'success': True,
+      'id': question_id,
+      'duplicate': duplicate
+    }
+
+  @app.route('/questions/search', methods=['POST'])
+  async def search_questions(request):
+    """
+    This function handles requested search for questions
+    and answers, ranked by relevance and paginated.
+    """
+    try:
+      search_term = parse_search_term(request.get_json())
+    except ValueError as error:
+      abort(400, str(error))
+    fields = get_fields(request)
+    current_category = request.args.get('category', None, type=int)
+    per_page = get_page_size(request.args, settings)
+    page = request.args.get('page', 1, type=int)
+    if page < 1:
+      abort(404)
+    if not tokenize(search_term):
+      # a term without any word matches nothing, like the flaskr backends
+      question_ids, total_questions = [], 0
+    elif db.dialect == 'postgresql':
+      count, ids, params = search.statements(search_term, current_category,
+                                             per_page, (page - 1) * per_page)
+      async with db.session() as session:
+        total_questions = await session.scalar(count, params)
+        question_ids = [row[0] for row in await session.fetch(ids, params)]
+    else:
+      question_ids, total_questions = (await fresh_search_index())\
+        .search(search_term, current_category, per_page, (page - 1) * per_page)
+    return {
+      'success': True,
+      'questions': encode_rows(await load_questions(question_ids, fields),
+                               fields),
+      'total_questions': total_questions
+    }
+
+  @app.route('/categories/<int:cat_id>/questions', methods=['GET'])
+  async def get_category_questions(request, cat_id):
+    """
+    This function handles requests for paginated questions based on
+    a category, optionally filtered by difficulty and sorted.
+    """
+    current_category = (await fresh_categories()).get(cat_id)
+    if current_category is None:
+      abort(404)
+    difficulty = request.args.get('difficulty', None, type=int)
+    min_difficulty = request.args.get('min_difficulty', difficulty, type=int)
+    max_difficulty = request.args.get('max_difficulty', difficulty, type=int)
+    sort = request.args.get('sort', 'id')
+    if sort.lstrip('-') not in CATEGORY_SORT_COLUMNS:
+      abort(400, 'Invalid sort value!')
+    sort_column = CATEGORY_SORT_COLUMNS[sort.lstrip('-')]
+    fields = get_fields(request)
+
+    criteria = [Question.category == cat_id]
+    if min_difficulty is not None:
+      criteria.append(Question.difficulty >= min_difficulty)
+    if max_difficulty is not None:
+      criteria.append(Question.difficulty <= max_difficulty)
+    questions, next_cursor = await paginate(
+      request, criteria, sort_column, descending=sort.startswith('-'),
+      fields=fields)
+
+    difficulty_counts = dict(await fetch_query(
+      Query([Question.difficulty, func.count(Question.id)])
+      .filter(Question.category == cat_id)
+      .filter(Question.difficulty.isnot(None))
+      .group_by(Question.difficulty)))
+    total_questions = sum(count for value, count in difficulty_counts.items()
+                          if (min_difficulty is None or value >= min_difficulty)
+                          and (max_difficulty is None or value <= max_difficulty))
+    return {
+      'success': True,
+      'questions': encode_rows(questions, fields),
+      'total_questions': total_questions,
+      'next_cursor': next_cursor,
+      'difficulty_counts': difficulty_counts,
+      'current_category': current_category
+    }
+
+  @app.route('/quizzes', methods=['POST'])
+  async def select_random_question(request):
+    """
+    This function handles the process of selecting a random question
+    based on a category if specified, and previous questions
+    to eleminate repetition.
+    """
+    try:
+      category, seen = parse_quiz_request(request.get_json(),
+                                          settings['SECRET_KEY'])
+    except ValueError as error:
+      abort(400, str(error))
+    question = None
+    question_id = (await fresh_question_pool()).draw(category, seen)
+    while question_id is not None:
+      rows = await load_questions([question_id])
+      if rows:
+        question = format_question(rows[0])
+        break
+      # deleted by another worker since the pool was built
+      question_pool.invalidate()
+      seen.add(question_id)
+      question_id = (await fresh_question_pool()).draw(category, seen)
+
+    if question is not None:
+      seen.add(question['id'])
+    return {
+      'success': True,
+      'question': question,
+      'seen_token': dump_seen_token(seen, settings['SECRET_KEY'])
+    }
+
+  return app
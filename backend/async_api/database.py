@@ -0,0 +1,162 @@
+import asyncio
+import re
+from contextlib import asynccontextmanager
+
+# :name parameters, but not the second colon of a ::type cast
+NAMED_PARAMETER = re.compile(r'(?<![:\w]):(\w+)')
+
+
+def driver_missing(driver):
+  return RuntimeError(f'{driver} is not installed, '
+                      'run pip install -r requirements-async.txt')
+
+
+class Session:
+  """
+  One connection of the async database, inside a transaction when it
+  comes from `Database.transaction`. Statements take :name parameters
+  and rows come back as tuples.
+  """
+
+  def __init__(self, database, connection):
+    self.database = database
+    self.connection = connection
+
+  async def fetch(self, statement, params=None):
+    if self.database.dialect == 'postgresql':
+      statement, args = self.database.positional(statement, params)
+      return [tuple(row) for row in
+              await self.connection.fetch(statement, *args)]
+    cursor = await self.connection.execute(statement, params or {})
+    rows = await cursor.fetchall()
+    await cursor.close()
+    return [tuple(row) for row in rows]
+
+  async def scalar(self, statement, params=None):
+    rows = await self.fetch(statement, params)
+    return rows[0][0] if rows else None
+
+  async def execute(self, statement, params=None):
+    """
+    This function runs a statement and returns the number of affected rows.
+    """
+    if self.database.dialect == 'postgresql':
+      statement, args = self.database.positional(statement, params)
+      status = await self.connection.execute(statement, *args)
+      # asyncpg returns the command tag, e.g. 'DELETE 1'
+      count = status.rsplit(' ', 1)[-1]
+      return int(count) if count.isdigit() else 0
+    cursor = await self.connection.execute(statement, params or {})
+    await cursor.close()
+    return cursor.rowcount
+
+
+class Database:
+  """
+  Async access to the trivia database through asyncpg (PostgreSQL) or
+  aiosqlite (SQLite). Takes the same URIs as SQLALCHEMY_DATABASE_URI.
+  The drivers are imported on `connect`, so the Flask app does not
+  depend on them.
+  """
+
+  def __init__(self, uri, pool_size=15, statement_timeout=None):
+    scheme, _, rest = uri.partition('://')
+    if scheme == 'sqlite':
+      self.dialect = 'sqlite'
+      # sqlite:////abs/path, sqlite:///relative/path or sqlite:// (memory)
+      self.dsn = rest[1:] if rest.startswith('/') else ':memory:'
+    elif scheme.split('+')[0] in ('postgres', 'postgresql'):
+      self.dialect = 'postgresql'
+      self.dsn = f'postgresql://{rest}'
+    else:
+      raise ValueError(f'Unsupported database URI: {uri}')
+    self.pool_size = pool_size
+    self.statement_timeout = statement_timeout
+    self.pool = None
+    self.statements = {}
+    self.connecting = asyncio.Lock()
+    self.writing = asyncio.Lock()
+
+  async def connect(self):
+    if self.pool is not None:
+      return
+    async with self.connecting:
+      if self.pool is not None:
+        return
+      if self.dialect == 'postgresql':
+        try:
+          import asyncpg
+        except ImportError:
+          raise driver_missing('asyncpg')
+        settings = {}
+        if self.statement_timeout:
+          settings['statement_timeout'] = str(int(self.statement_timeout))
+        self.pool = await asyncpg.create_pool(self.dsn,
+                                              min_size=1,
+                                              max_size=self.pool_size,
+                                              server_settings=settings)
+      else:
+        try:
+          import aiosqlite
+        except ImportError:
+          raise driver_missing('aiosqlite')
+        # one connection: sqlite serializes writers anyway
+        self.pool = await aiosqlite.connect(self.dsn)
+
+  async def close(self):
+    if self.pool is not None:
+      await self.pool.close()
+      self.pool = None
+
+  def positional(self, statement, params):
+    """
+    This function rewrites :name parameters to asyncpg's $n placeholders
+    and returns the statement with its argument list.
+    """
+    if statement not in self.statements:
+      names = []
+
+      def placeholder(match):
+        if match.group(1) not in names:
+          names.append(match.group(1))
+        return f'${names.index(match.group(1)) + 1}'
+
+      self.statements[statement] = (NAMED_PARAMETER.sub(placeholder, statement),
+                                    names)
+    statement, names = self.statements[statement]
+    return statement, [params[name] for name in names]
+
+  @asynccontextmanager
+  async def session(self):
+    if self.dialect == 'postgresql':
+      async with self.pool.acquire() as connection:
+        yield Session(self, connection)
+    else:
+      yield Session(self, self.pool)
+
+  @asynccontextmanager
+  async def transaction(self):
+    """
+    This function yields a session whose statements commit together
+    when the block exits, or roll back if it raises.
+    """
+    if self.dialect == 'postgresql':
+      async with self.pool.acquire() as connection:
+        async with connection.transaction():
+          yield Session(self, connection)
+      return
+    async with self.writing:
+      try:
+        yield Session(self, self.pool)
+      except BaseException:
+        await self.pool.rollback()
+        raise
+      await self.pool.commit()
+
+  async def fetch(self, statement, params=None):
+    async with self.session() as session:
+      return await session.fetch(statement, params)
+
+  async def scalar(self, statement, params=None):
+    async with self.session() as session:
+      return await session.scalar(statement, params)
@@ -0,0 +1,118 @@
+import json
+import re
+
+from werkzeug.exceptions import HTTPException, BadRequest, MethodNotAllowed, \
+                                NotFound
+from werkzeug.urls import url_decode
+
+from flaskr.serialization import dumps
+
+# the messages of the flaskr error handlers, 400 sends its description
+ERROR_MESSAGES = {
+  404: 'resource not found!',
+  405: 'method not allowed!',
+  422: 'unprocessable!',
+  500: 'internal server error!',
+}
+CORS_HEADERS = [
+  (b'access-control-allow-origin', b'*'),
+  (b'access-control-allow-headers', b'Content-Type,Authorization,true'),
+  (b'access-control-allow-methods', b'GET,PATCH,POST,DELETE,OPTIONS'),
+]
+
+
+class Request:
+  """
+  The parts of an ASGI request the handlers use, with Flask's
+  `args.get(key, default, type)` and `get_json()` behaviour.
+  """
+
+  def __init__(self, scope, body):
+    self.method = scope['method']
+    self.path = scope['path']
+    self.args = url_decode(scope['query_string'])
+    self.headers = {name.decode('latin-1').lower(): value.decode('latin-1')
+                    for name, value in scope['headers']}
+    self.body = body
+
+  @property
+  def mimetype(self):
+    return self.headers.get('content-type', '').split(';')[0].strip().lower()
+
+  def get_json(self):
+    """
+    This function returns the parsed JSON body, or None when the request
+    is not sent as JSON.
+    """
+    mimetype = self.mimetype
+    if not (mimetype == 'application/json' or
+            (mimetype.startswith('application/') and
+             mimetype.endswith('+json'))):
+      return None
+    try:
+      return json.loads(self.body)
+    except ValueError:
+      raise BadRequest('Failed to decode JSON object')
+
+
+class Router:
+  """
+  Maps '/path/<int:name>' rules and methods to async handlers.
+  """
+
+  def __init__(self):
+    self.routes = []
+
+  def route(self, rule, methods):
+    pattern = re.compile('^' + re.sub(r'<int:(\w+)>', r'(?P<\1>[0-9]+)', rule)
+                         + '$')
+
+    def register(handler):
+      self.routes.append((pattern, set(methods), handler))
+      return handler
+    return register
+
+  def methods(self, path):
+    """
+    This function returns the methods routed for a path.
+    """
+    return set().union(*[methods for pattern, methods, handler in self.routes
+                         if pattern.match(path)])
+
+  def match(self, method, path):
+    """
+    This function returns the handler and the path arguments of a request,
+    or raises NotFound / MethodNotAllowed like Flask's routing does.
+    """
+    for pattern, methods, handler in self.routes:
+      found = pattern.match(path)
+      if found is not None and method in methods:
+        return handler, {name: int(value)
+                         for name, value in found.groupdict().items()}
+    allowed = self.methods(path)
+    if not allowed:
+      raise NotFound()
+    raise MethodNotAllowed(sorted(allowed))
+
+
+def error_body(error):
+  """
+  This function formats an HTTP error like the flaskr error handlers.
+  """
+  code = error.code if isinstance(error, HTTPException) else 500
+  message = error.description if code == 400 else \
+            ERROR_MESSAGES.get(code, getattr(error, 'description', None))
+  return code, {'success': False, 'error': code, 'message': message}
+
+
+def encode_json(data, encoder):
+  # the body flaskr's jsonify sends for the same data
+  return dumps(data, encoder) + b'\n'
+
+
+async def send_response(send, status, body, content_type=b'application/json'):
+  headers = [(b'content-type', content_type),
+             (b'content-length', str(len(body)).encode())] + CORS_HEADERS
+  await send({'type': 'http.response.start', 'status': status,
+              'headers': headers})
+  await send({'type': 'http.response.body', 'body': body})
@@ -0,0 +1,157 @@
+"""
+Benchmark every Trivia API route against synthetic question banks.
+
+    python -m benchmarks --sizes 10000,100000 --output results.json
+    python -m benchmarks --sizes 10000 --baseline results.json
+
+Without --database-uri every size gets a fresh SQLite file. With a
+PostgreSQL URI the database must be empty, or --reset has to be given.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+from flaskr import create_app
+from models import db, Question
+from .dataset import generate_questions
+from .load import default_scenarios, run_inprocess, run_http, Server, \
+                   BENCHMARK_CONFIG, format_ms
+
+# a result regresses when p95 latency or throughput is off by more than this
+DEFAULT_TOLERANCE = 0.2
+
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser(prog='python -m benchmarks',
+                                   description=__doc__.strip().splitlines()[0])
+  parser.add_argument('--sizes', default='10000',
+                      help='comma separated question bank sizes')
+  parser.add_argument('--skew', type=float, default=1.0,
+                      help='Zipf exponent of the category distribution')
+  parser.add_argument('--requests', type=int, default=200,
+                      help='requests per route and mode')
+  parser.add_argument('--concurrency', type=int, default=8,
+                      help='HTTP load generator threads')
+  parser.add_argument('--mode', choices=['inprocess', 'http', 'both'],
+                      default='both')
+  parser.add_argument('--routes', default=None,
+                      help='only run routes whose name contains one of these '
+                           'comma separated strings')
+  parser.add_argument('--database-uri', default=None)
+  parser.add_argument('--reset', action='store_true',
+                      help='empty a non-empty benchmark database first')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--output', default=None, help='write results as JSON')
+  parser.add_argument('--baseline', default=None,
+                      help='compare against a previous JSON result file')
+  parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+  return parser.parse_args(argv)
+
+
+def benchmark_size(args, size, directory):
+  uri = args.database_uri or \
+        f'sqlite:///{os.path.join(directory, f"bench_{size}.db")}'
+  app = create_app(dict(BENCHMARK_CONFIG, SQLALCHEMY_DATABASE_URI=uri))
+  with app.app_context():
+    started = time.perf_counter()
+    category_ids = generate_questions(size, args.skew, args.seed, args.reset)
+    print(f'generated {size} questions in '
+          f'{time.perf_counter() - started:.1f}s', file=sys.stderr)
+    first_id = db.session.query(db.func.min(Question.id)).scalar()
+    last_id = db.session.query(db.func.max(Question.id)).scalar()
+  pages = max(1, size // app.config['QUESTIONS_PER_PAGE'])
+  scenarios = default_scenarios(category_ids, first_id, last_id, pages)
+  if args.routes:
+    wanted = args.routes.split(',')
+    scenarios = [scenario for scenario in scenarios
+                 if any(name in scenario.name for name in wanted)]
+
+  results = []
+  modes = ['inprocess', 'http'] if args.mode == 'both' else [args.mode]
+  for mode in modes:
+    for scenario in scenarios:
+      if mode == 'inprocess':
+        result = run_inprocess(app, scenario, args.requests, args.seed)
+      else:
+        with Server(app) as server:
+          result = run_http(server.port, scenario, args.requests,
+                            args.concurrency, args.seed)
+      result.update({'size': size, 'mode': mode})
+      results.append(result)
+      print(f"{size:>9} {mode:<9} {result['route']:<32} "
+            f"{result['throughput_rps']:>9.1f} rps  "
+            f"p50 {format_ms(result['p50_ms'])}  "
+            f"p95 {format_ms(result['p95_ms'])}  "
+            f"p99 {format_ms(result['p99_ms'])} ms  "
+            f"queries {result['mean_queries']}  "
+            f"non-2xx {result['non_2xx']}", file=sys.stderr)
+  return results
+
+
+def compare(results, baseline, tolerance):
+  """
+  This function lists results that are slower (p95) or have lower
+  throughput than the matching baseline result by more than `tolerance`.
+  """
+  previous = {(result['size'], result['mode'], result['route']): result
+              for result in baseline['results']}
+  regressions = []
+  for result in results:
+    old = previous.get((result['size'], result['mode'], result['route']))
+    if old is None or result['p95_ms'] is None or old['p95_ms'] is None:
+      continue
+    if result['p95_ms'] > old['p95_ms'] * (1 + tolerance):
+      regressions.append(f"{result['route']} ({result['mode']}, "
+                         f"{result['size']}): p95 {old['p95_ms']} -> "
+                         f"{result['p95_ms']} ms")
+    if result['throughput_rps'] < old['throughput_rps'] * (1 - tolerance):
+      regressions.append(f"{result['route']} ({result['mode']}, "
+                         f"{result['size']}): throughput "
+                         f"{old['throughput_rps']} -> "
+                         f"{result['throughput_rps']} rps")
+  return regressions
+
+
+def main(argv=None):
+  args = parse_args(argv)
+  sizes = [int(size) for size in args.sizes.split(',')]
+  if args.database_uri and len(sizes) > 1 and not args.reset:
+    sys.exit('several sizes on one --database-uri need --reset')
+
+  results = []
+  with tempfile.TemporaryDirectory() as directory:
+    for size in sizes:
+      results.extend(benchmark_size(args, size, directory))
+
+  report = {
+    'meta': {
+      'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+      'python': platform.python_version(),
+      'platform': platform.platform(),
+      'skew': args.skew,
+      'requests': args.requests,
+      'concurrency': args.concurrency,
+      'seed': args.seed,
+      'database': 'custom' if args.database_uri else 'sqlite',
+    },
+    'results': results,
+  }
+  if args.output:
+    with open(args.output, 'w') as output:
+      json.dump(report, output, indent=2)
+
+  if args.baseline:
+    with open(args.baseline) as baseline:
+      regressions = compare(results, json.load(baseline), args.tolerance)
+    for regression in regressions:
+      print(f'REGRESSION {regression}', file=sys.stderr)
+    if regressions:
+      sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
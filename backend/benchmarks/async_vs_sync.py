@@ -0,0 +1,154 @@
+"""
+Compare the Flask app and the async (ASGI) app under concurrent load.
+
+    python -m benchmarks.async_vs_sync --size 10000 --concurrency 64
+
+Both apps serve the same database and the same scenarios over HTTP, each
+from its own process: the Flask app from a threaded werkzeug server, the
+async app from uvicorn.
+Without --database-uri a fresh SQLite file is used; with aiosqlite every
+query still runs on one thread, so PostgreSQL (asyncpg) is where the
+async mode is meant to be measured.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import socket
+import sys
+import tempfile
+import time
+
+from flaskr import create_app
+from models import db, Question
+import async_api
+from .dataset import generate_questions
+from .load import default_scenarios, run_http, BENCHMARK_CONFIG, \
+                   format_ms
+
+
+def serve(kind, uri, port):
+  if kind == 'sync':
+    from werkzeug.serving import make_server
+    from .load import QuietRequestHandler
+    app = create_app(dict(BENCHMARK_CONFIG, SQLALCHEMY_DATABASE_URI=uri))
+    make_server('127.0.0.1', port, app, threaded=True,
+                request_handler=QuietRequestHandler).serve_forever()
+  else:
+    import uvicorn
+    uvicorn.run(async_api.create_app({'SQLALCHEMY_DATABASE_URI': uri}),
+                host='127.0.0.1', port=port, log_level='warning',
+                access_log=False)
+
+
+class ServerProcess:
+  """
+  Serves the sync or the async app from its own process on a free port,
+  so neither server shares a GIL with the load generator threads.
+  """
+
+  def __init__(self, kind, uri):
+    with socket.socket() as probe:
+      probe.bind(('127.0.0.1', 0))
+      self.port = probe.getsockname()[1]
+    self.process = multiprocessing.get_context('spawn')\
+                   .Process(target=serve, args=(kind, uri, self.port),
+                            daemon=True)
+
+  def __enter__(self):
+    self.process.start()
+    deadline = time.monotonic() + 30
+    while True:
+      try:
+        socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+        return self
+      except OSError:
+        if time.monotonic() > deadline or not self.process.is_alive():
+          raise RuntimeError('benchmark server did not start')
+        time.sleep(0.05)
+
+  def __exit__(self, *exc_info):
+    self.process.terminate()
+    self.process.join()
+
+
+def routed(app, scenario):
+  """
+  This function tells whether the async app serves a scenario's route;
+  it only ports part of the API, so the other routes are not compared.
+  """
+  method, path = scenario.name.split(' ', 1)
+  path = re.sub(r'<\w+>', '1', path.split('?', 1)[0])
+  return method in app.router.methods(path)
+
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser(prog='python -m benchmarks.async_vs_sync',
+                                   description=__doc__.strip().splitlines()[0])
+  parser.add_argument('--size', type=int, default=10000)
+  parser.add_argument('--skew', type=float, default=1.0)
+  parser.add_argument('--requests', type=int, default=1000,
+                      help='requests per route and app')
+  parser.add_argument('--concurrency', type=int, default=64,
+                      help='HTTP load generator threads')
+  parser.add_argument('--routes', default=None,
+                      help='only run routes whose name contains one of these '
+                           'comma separated strings')
+  parser.add_argument('--database-uri', default=None)
+  parser.add_argument('--reset', action='store_true')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--output', default=None, help='write results as JSON')
+  return parser.parse_args(argv)
+
+
+def benchmark(args, uri):
+  app = create_app({'SQLALCHEMY_DATABASE_URI': uri})
+  with app.app_context():
+    category_ids = generate_questions(args.size, args.skew, args.seed,
+                                      args.reset)
+    first_id = db.session.query(db.func.min(Question.id)).scalar()
+    last_id = db.session.query(db.func.max(Question.id)).scalar()
+  pages = max(1, args.size // app.config['QUESTIONS_PER_PAGE'])
+  # the async app only connects to the database on its first request
+  async_app = async_api.create_app({'SQLALCHEMY_DATABASE_URI': uri})
+  scenarios = [scenario for scenario
+               in default_scenarios(category_ids, first_id, last_id, pages)
+               if routed(async_app, scenario)]
+  if args.routes:
+    wanted = args.routes.split(',')
+    scenarios = [scenario for scenario in scenarios
+                 if any(name in scenario.name for name in wanted)]
+
+  results = []
+  for scenario in scenarios:
+    for name in ('sync', 'async'):
+      with ServerProcess(name, uri) as server:
+        result = run_http(server.port, scenario, args.requests,
+                          args.concurrency, args.seed)
+      result.update({'size': args.size, 'app': name,
+                     'concurrency': args.concurrency})
+      results.append(result)
+      print(f"{name:<6} {result['route']:<32} "
+            f"{result['throughput_rps']:>9.1f} rps  "
+            f"p50 {format_ms(result['p50_ms'])}  "
+            f"p95 {format_ms(result['p95_ms'])}  "
+            f"p99 {format_ms(result['p99_ms'])} ms  non-2xx {result['non_2xx']}  "
+            f"errors {result['errors']}",
+            file=sys.stderr)
+  return results
+
+
+def main(argv=None):
+  args = parse_args(argv)
+  with tempfile.TemporaryDirectory() as directory:
+    uri = args.database_uri or \
+          f'sqlite:///{os.path.join(directory, "bench.db")}'
+    results = benchmark(args, uri)
+  if args.output:
+    with open(args.output, 'w') as output:
+      json.dump({'results': results}, output, indent=2)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,65 @@
+import random
+
+from models import db, Question, QuestionStat, Category, bump_version
+from migrations import migrate
+from flaskr.bulk import insert_batch
+
+CATEGORIES = ['Science', 'Art', 'Geography', 'History', 'Entertainment',
+              'Sports']
+# search terms are drawn from the same vocabulary as the question text
+VOCABULARY = ['world', 'cup', 'title', 'river', 'painter', 'planet', 'movie',
+              'king', 'ocean', 'element', 'novel', 'team', 'mountain', 'war',
+              'album', 'capital', 'island', 'symphony', 'empire', 'desert',
+              'league', 'theory', 'festival', 'bridge', 'language', 'galaxy',
+              'olympic', 'sculpture', 'dynasty', 'volcano', 'studio', 'medal']
+BATCH_SIZE = 5000
+
+
+def category_weights(count, skew):
+  """
+  This function returns Zipf-like weights: with skew 0 every category is
+  equally likely, with skew 1 the first one gets twice the second, etc.
+  """
+  return [1 / (rank ** skew) for rank in range(1, count + 1)]
+
+
+def generate_questions(size, skew=1.0, seed=0, reset=False):
+  """
+  This function fills the current app's database with the standard
+  categories and `size` synthetic questions whose categories follow
+  `category_weights`. Refuses to touch a non-empty database unless `reset`.
+  Returns the category ids.
+  """
+  migrate(db.get_engine(), log=lambda message: None)
+  if Question.query.first() is not None or Category.query.first() is not None:
+    if not reset:
+      raise RuntimeError('benchmark database is not empty, pass reset=True')
+    Question.query.delete()
+    QuestionStat.query.delete()
+    Category.query.delete()
+    db.session.commit()
+
+  for name in CATEGORIES:
+    db.session.add(Category(name))
+  db.session.commit()
+  bump_version('categories')
+  category_ids = [category.id for category in Category.query.order_by(Category.id)]
+
+  generator = random.Random(seed)
+  weights = category_weights(len(category_ids), skew)
+  batch = []
+  for number in range(size):
+    words = generator.sample(VOCABULARY, 6)
+    batch.append((f'Question {number}: which {" ".join(words[:5])}?',
+                  words[5].title(),
+                  generator.choices(category_ids, weights)[0],
+                  generator.randint(1, 5)))
+    if len(batch) == BATCH_SIZE:
+      insert_batch(batch)
+      db.session.commit()
+      batch = []
+  if batch:
+    insert_batch(batch)
+    db.session.commit()
+  bump_version('questions')
+  return category_ids
@@ -0,0 +1,113 @@
+"""
+Measure the CPU time and bytes saved by sparse fieldsets (?fields=).
+
+    python -m benchmarks.fields --size 10000 --per-page 10,100
+
+Renders pages of questions with full ORM objects and Question.format(),
+with the full column-only select, and with column-only selects of each
+fieldset in --fields, then serves GET /questions?fields= in-process.
+All times are CPU time per page or response.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from flaskr import create_app
+from flaskr.serialization import dumps, encode_rows, get_encoder, \
+                                 parse_fields, stdlib_dumps, with_columns
+from models import db, Question
+from .dataset import generate_questions
+from .serialization import cpu_per_call
+
+
+def fieldset_paths(page, fieldsets, encoder):
+  """
+  This function returns (name, render) for the ways to render one page
+  of questions, starting with ORM objects and Question.format().
+  """
+  def orm_format():
+    questions = Question.query.order_by(Question.id).limit(page).all()
+    return stdlib_dumps({'questions': [question.format()
+                                       for question in questions]})
+
+  def rows(fields):
+    def render():
+      rows = db.session.query(*with_columns(parse_fields(fields), Question.id))\
+             .order_by(Question.id).limit(page).all()
+      return dumps({'questions': encode_rows(rows, parse_fields(fields))},
+                   encoder)
+    return render
+
+  return [('orm+format', orm_format), ('rows', rows(None))] + \
+         [(f'rows fields={fields}', rows(fields)) for fields in fieldsets]
+
+
+def wire_results(app, page, fieldsets, repeat):
+  client = app.test_client()
+  pages = max(1, Question.query.count() // page)
+  results = []
+  for fields in [None] + fieldsets:
+    query = '' if fields is None else f'&fields={fields}'
+    sizes = []
+    started = time.process_time()
+    for number in range(repeat):
+      response = client.get(f'/questions?per_page={page}'
+                            f'&page={number % pages + 1}{query}',
+                            headers={'Accept-Encoding': 'identity'})
+      sizes.append(len(response.get_data()))
+    results.append({'per_page': page, 'fields': fields,
+                    'cpu_us': round((time.process_time() - started)
+                                    / repeat * 1e6, 1),
+                    'mean_bytes': round(sum(sizes) / len(sizes))})
+  return results
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog='python -m benchmarks.fields',
+                                   description=__doc__.strip().splitlines()[0])
+  parser.add_argument('--size', type=int, default=10000)
+  parser.add_argument('--per-page', default='10,100',
+                      help='comma separated page sizes')
+  parser.add_argument('--fields', default='id;id,question;id,question,difficulty',
+                      help='semicolon separated fieldsets')
+  parser.add_argument('--repeat', type=int, default=500)
+  parser.add_argument('--output', default=None, help='write results as JSON')
+  args = parser.parse_args(argv)
+  fieldsets = args.fields.split(';')
+
+  results = {'render': [], 'wire': []}
+  with tempfile.TemporaryDirectory() as directory:
+    # every response is rendered: the response cache would hide the work
+    app = create_app({
+      'SQLALCHEMY_DATABASE_URI':
+        f'sqlite:///{os.path.join(directory, "bench.db")}',
+      'RESPONSE_CACHE_SIZE': 0,
+      'MAX_QUESTIONS_PER_PAGE': 1000,
+      'METRICS_ENABLED': False
+    })
+    with app.app_context():
+      generate_questions(args.size)
+      encoder = get_encoder(app.config['JSON_BACKEND'])
+      for page in [int(page) for page in args.per_page.split(',')]:
+        for name, render in fieldset_paths(page, fieldsets, encoder):
+          result = {'per_page': page, 'path': name,
+                    'cpu_us': cpu_per_call(render, args.repeat),
+                    'bytes': len(render())}
+          results['render'].append(result)
+          print(f"{page:>5} {name:<40} {result['cpu_us']:>9.1f} us  "
+                f"{result['bytes']:>8} bytes", file=sys.stderr)
+        for result in wire_results(app, page, fieldsets, args.repeat):
+          results['wire'].append(result)
+          print(f"{page:>5} GET /questions fields={result['fields'] or '*':<22} "
+                f"{result['cpu_us']:>9.1f} us  "
+                f"{result['mean_bytes']:>8} bytes", file=sys.stderr)
+  if args.output:
+    with open(args.output, 'w') as output:
+      json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,283 @@
+import http.client
+import json
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+from .dataset import VOCABULARY
+
+SERVER_TIMING_QUERIES = re.compile(r'desc="(\d+) queries"')
+# create_app settings of the benchmarked Flask app: without deadlines and
+# load shedding, so every request is served rather than turned away fast
+BENCHMARK_CONFIG = {
+  'ROUTE_DEADLINES': {},
+  'DEFAULT_DEADLINE': None,
+  'ROUTE_CONCURRENCY': {}
+}
+# questions per POST /questions/batch and POST /questions/bulk request
+WRITE_BATCH_SIZE = 20
+
+
+class Scenario:
+  """
+  One benchmarked route: `build(rng)` returns the (method, path, body) of
+  the next request, so every request can use different arguments. The
+  body is sent as JSON, or as NDJSON when it is bytes.
+  With `prepare`, `prepare(rng, send)` runs untimed before every request,
+  e.g. to create the questions it deletes, and `build(rng, prepared)` gets
+  its result; `send(method, path, body)` returns the decoded JSON reply.
+  """
+
+  def __init__(self, name, build, prepare=None):
+    self.name = name
+    self.build = build
+    self.prepare = prepare
+
+  def next_request(self, rng, send):
+    if self.prepare is None:
+      return self.build(rng)
+    return self.build(rng, self.prepare(rng, send))
+
+
+def default_scenarios(category_ids, first_id, last_id, pages):
+  """
+  This function returns a scenario for every route of the API.
+  Write scenarios come last so they do not disturb the read measurements.
+  """
+  def quiz(rng):
+    previous = [rng.randint(first_id, last_id) for _ in range(rng.randint(0, 20))]
+    category = rng.choice([0] + category_ids)
+    return 'POST', '/quizzes', {'previous_questions': previous,
+                                'quiz_category': {'id': category}}
+
+  def new_question(rng):
+    # random text, so the duplicate check never skips the insert
+    return {'question': f'Benchmark {rng.random()}?',
+            'answer': 'Yes',
+            'category': rng.choice(category_ids),
+            'difficulty': rng.randint(1, 5)}
+
+  def add(rng):
+    return 'POST', '/questions', new_question(rng)
+
+  def add_batch(rng):
+    return 'POST', '/questions/batch', {
+      'questions': [new_question(rng) for _ in range(WRITE_BATCH_SIZE)]}
+
+  def import_bulk(rng):
+    lines = [json.dumps(new_question(rng)) for _ in range(WRITE_BATCH_SIZE)]
+    return 'POST', '/questions/bulk', '\n'.join(lines).encode()
+
+  def create_one(rng, send):
+    return send(*add(rng))['id']
+
+  def create_batch(rng, send):
+    return [result['id'] for result in send(*add_batch(rng))['results']]
+
+  return [
+    Scenario('GET /categories', lambda rng: ('GET', '/categories', None)),
+    Scenario('GET /questions?page',
+             lambda rng: ('GET', f'/questions?page={rng.randint(1, pages)}',
+                          None)),
+    Scenario('GET /questions?after',
+             lambda rng: ('GET',
+                          f'/questions?after={rng.randint(first_id, last_id)}',
+                          None)),
+    Scenario('GET /categories/<id>/questions',
+             lambda rng: ('GET',
+                          f'/categories/{rng.choice(category_ids)}/questions',
+                          None)),
+    Scenario('POST /questions/search',
+             lambda rng: ('POST', '/questions/search',
+                          {'searchTerm': ' '.join(rng.sample(VOCABULARY,
+                                                             rng.randint(1, 2)))})),
+    Scenario('GET /questions/suggest',
+             lambda rng: ('GET', '/questions/suggest?prefix='
+                          f'{rng.choice(VOCABULARY)[:rng.randint(1, 4)]}',
+                          None)),
+    Scenario('GET /questions/changes',
+             lambda rng: ('GET', '/questions/changes?since=0&wait=0', None)),
+    Scenario('GET /stats', lambda rng: ('GET', '/stats', None)),
+    Scenario('GET /questions/bulk',
+             lambda rng: ('GET', '/questions/bulk', None)),
+    Scenario('POST /quizzes', quiz),
+    Scenario('POST /questions', add),
+    Scenario('POST /questions/batch', add_batch),
+    Scenario('POST /questions/bulk', import_bulk),
+    # every delete removes questions created for it, untimed, just before
+    Scenario('DELETE /questions/<id>',
+             lambda rng, question_id: ('DELETE', f'/questions/{question_id}',
+                                       None),
+             prepare=create_one),
+    Scenario('DELETE /questions/batch',
+             lambda rng, ids: ('DELETE', '/questions/batch', {'ids': ids}),
+             prepare=create_batch),
+  ]
+
+
+def percentile(values, percent):
+  """
+  This function returns the nearest-rank percentile of sorted `values`.
+  """
+  if not values:
+    return None
+  rank = max(0, min(len(values) - 1, int(round(percent / 100 * len(values))) - 1))
+  return values[rank]
+
+
+def summarize(scenario, samples, elapsed):
+  """
+  This function turns (latency, status, queries, size) samples into a result.
+  Latency and throughput only count 2xx responses; the others are
+  reported as `non_2xx` (`errors` for the 5xx among them).
+  """
+  served = [sample for sample in samples if 200 <= sample[1] < 300]
+  latencies = sorted(sample[0] for sample in served)
+  queries = [sample[2] for sample in samples if sample[2] is not None]
+
+  def milliseconds(percent):
+    value = percentile(latencies, percent)
+    return None if value is None else round(value * 1000, 3)
+
+  return {
+    'route': scenario.name,
+    'requests': len(samples),
+    'non_2xx': len(samples) - len(served),
+    'errors': sum(1 for sample in samples if sample[1] >= 500),
+    'throughput_rps': round(len(served) / elapsed, 2) if elapsed else None,
+    'p50_ms': milliseconds(50),
+    'p95_ms': milliseconds(95),
+    'p99_ms': milliseconds(99),
+    'mean_queries': round(sum(queries) / len(queries), 2) if queries else None,
+    'mean_bytes': round(sum(sample[3] for sample in samples) / len(samples)),
+  }
+
+
+def format_ms(value):
+  # fixed width, '-' when no request was served
+  return f'{value:>8.2f}' if value is not None else f"{'-':>8}"
+
+
+def query_count(server_timing):
+  match = SERVER_TIMING_QUERIES.search(server_timing or '')
+  return int(match.group(1)) if match else None
+
+
+def run_inprocess(app, scenario, requests, seed=0):
+  """
+  This function drives a scenario sequentially through the Flask test client.
+  """
+  client = app.test_client()
+  rng = random.Random(seed)
+  samples = []
+
+  def request(method, path, body):
+    if isinstance(body, bytes):
+      return client.open(path, method=method, data=body,
+                         content_type='application/x-ndjson')
+    return client.open(path, method=method, json=body)
+
+  def send(method, path, body):
+    return request(method, path, body).get_json()
+
+  untimed = 0.0
+  started = time.perf_counter()
+  for _ in range(requests):
+    prepare_start = time.perf_counter()
+    method, path, body = scenario.next_request(rng, send)
+    start = time.perf_counter()
+    untimed += start - prepare_start
+    response = request(method, path, body)
+    data = response.get_data()
+    samples.append((time.perf_counter() - start, response.status_code,
+                    query_count(response.headers.get('Server-Timing')),
+                    len(data)))
+  return summarize(scenario, samples, time.perf_counter() - started - untimed)
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+  def log_request(self, *args, **kwargs):
+    pass
+
+
+class Server:
+  """
+  Serves the app from a threaded werkzeug server on a free local port.
+  """
+
+  def __init__(self, app):
+    self.server = make_server('127.0.0.1', 0, app, threaded=True,
+                              request_handler=QuietRequestHandler)
+    self.port = self.server.server_port
+    self.thread = threading.Thread(target=self.server.serve_forever,
+                                   daemon=True)
+
+  def __enter__(self):
+    self.thread.start()
+    return self
+
+  def __exit__(self, *exc_info):
+    self.server.shutdown()
+    self.thread.join()
+
+
+def run_http(port, scenario, requests, concurrency, seed=0):
+  """
+  This function drives a scenario over HTTP from `concurrency` threads,
+  each with its own keep-alive connection.
+  """
+  samples = []
+  untimed = []
+  lock = threading.Lock()
+
+  def worker(index, count):
+    rng = random.Random(seed * 1000 + index)
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+
+    def request(method, path, body):
+      if isinstance(body, bytes):
+        payload, headers = body, {'Content-Type': 'application/x-ndjson'}
+      elif body is not None:
+        payload = json.dumps(body).encode()
+        headers = {'Content-Type': 'application/json'}
+      else:
+        payload, headers = None, {}
+      connection.request(method, path, body=payload, headers=headers)
+      return connection.getresponse()
+
+    def send(method, path, body):
+      return json.loads(request(method, path, body).read())
+
+    local = []
+    prepare_time = 0.0
+    for _ in range(count):
+      prepare_start = time.perf_counter()
+      method, path, body = scenario.next_request(rng, send)
+      start = time.perf_counter()
+      prepare_time += start - prepare_start
+      response = request(method, path, body)
+      data = response.read()
+      local.append((time.perf_counter() - start, response.status,
+                    query_count(response.getheader('Server-Timing')),
+                    len(data)))
+    connection.close()
+    with lock:
+      samples.extend(local)
+      untimed.append(prepare_time)
+
+  shares = [requests // concurrency + (1 if index < requests % concurrency else 0)
+            for index in range(concurrency)]
+  started = time.perf_counter()
+  with ThreadPoolExecutor(concurrency) as executor:
+    for future in [executor.submit(worker, index, count)
+                   for index, count in enumerate(shares) if count]:
+      future.result()
+  # the workers prepare side by side: take out their mean untimed share
+  elapsed = time.perf_counter() - started
+  if untimed:
+    elapsed -= sum(untimed) / len(untimed)
+  return summarize(scenario, samples, elapsed)
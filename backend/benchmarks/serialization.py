@@ -0,0 +1,128 @@
+"""
+Measure JSON encoding CPU and bytes on the wire per response.
+
+    python -m benchmarks.serialization --size 10000 --per-page 10,100
+
+Compares the old per-row path (ORM objects, Question.format(), stdlib json)
+with the row-to-JSON path on each available JSON backend, with and without
+the query, then serves GET /questions pages in-process with every content
+encoding. All times are CPU time per response.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from flaskr import create_app
+from flaskr.compression import ENCODINGS
+from flaskr.serialization import ENCODERS, QUESTION_COLUMNS, dumps, \
+                                 encode_rows, stdlib_dumps
+from models import db, Question
+from .dataset import generate_questions
+
+
+def cpu_per_call(function, repeat):
+  """
+  This function returns the mean CPU time of `function` in microseconds.
+  """
+  started = time.process_time()
+  for _ in range(repeat):
+    function()
+  return round((time.process_time() - started) / repeat * 1e6, 1)
+
+
+def encoding_paths(page):
+  """
+  This function returns (name, fetch, encode) for the ways to render one
+  page of questions, starting with the old ORM + format() + json path.
+  """
+  def fetch_questions():
+    return Question.query.order_by(Question.id).limit(page).all()
+
+  def format_questions(questions):
+    return stdlib_dumps({'questions': [question.format()
+                                       for question in questions]})
+
+  def fetch_rows():
+    return db.session.query(*QUESTION_COLUMNS).order_by(Question.id)\
+           .limit(page).all()
+
+  def rows_encoder(encoder):
+    return lambda rows: dumps({'questions': encode_rows(rows, QUESTION_COLUMNS)},
+                              encoder)
+
+  paths = [('orm+format+json', fetch_questions, format_questions)]
+  paths += [(f'rows+{name}', fetch_rows, rows_encoder(encoder))
+            for name, encoder in sorted(ENCODERS.items())]
+  return paths
+
+
+def wire_results(app, page, repeat):
+  client = app.test_client()
+  pages = max(1, Question.query.count() // page)
+  results = []
+  for encoding in ['identity'] + ENCODINGS:
+    sizes = []
+    started = time.process_time()
+    for number in range(repeat):
+      response = client.get(f'/questions?per_page={page}'
+                            f'&page={number % pages + 1}',
+                            headers={'Accept-Encoding': encoding})
+      sizes.append(len(response.get_data()))
+    results.append({'per_page': page, 'encoding': encoding,
+                    'cpu_us': round((time.process_time() - started)
+                                    / repeat * 1e6, 1),
+                    'mean_bytes': round(sum(sizes) / len(sizes))})
+  return results
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog='python -m benchmarks.serialization',
+                                   description=__doc__.strip().splitlines()[0])
+  parser.add_argument('--size', type=int, default=10000)
+  parser.add_argument('--per-page', default='10,100',
+                      help='comma separated page sizes')
+  parser.add_argument('--repeat', type=int, default=500)
+  parser.add_argument('--output', default=None, help='write results as JSON')
+  args = parser.parse_args(argv)
+
+  results = {'encoding': [], 'wire': []}
+  with tempfile.TemporaryDirectory() as directory:
+    # every response is rendered: the response cache would hide the work
+    app = create_app({
+      'SQLALCHEMY_DATABASE_URI':
+        f'sqlite:///{os.path.join(directory, "bench.db")}',
+      'RESPONSE_CACHE_SIZE': 0,
+      'MAX_QUESTIONS_PER_PAGE': 1000,
+      'METRICS_ENABLED': False
+    })
+    with app.app_context():
+      generate_questions(args.size)
+      for page in [int(page) for page in args.per_page.split(',')]:
+        for name, fetch, encode in encoding_paths(page):
+          rows = fetch()
+          result = {'per_page': page, 'path': name,
+                    'fetch_and_encode_cpu_us':
+                      cpu_per_call(lambda: encode(fetch()), args.repeat),
+                    'encode_cpu_us':
+                      cpu_per_call(lambda: encode(rows), args.repeat),
+                    'bytes': len(encode(rows))}
+          results['encoding'].append(result)
+          print(f"{page:>5} {name:<18} "
+                f"{result['fetch_and_encode_cpu_us']:>9.1f} us fetch+encode  "
+                f"{result['encode_cpu_us']:>9.1f} us encode  "
+                f"{result['bytes']:>8} bytes", file=sys.stderr)
+        for result in wire_results(app, page, args.repeat):
+          results['wire'].append(result)
+          print(f"{page:>5} GET /questions {result['encoding']:<9} "
+                f"{result['cpu_us']:>9.1f} us  "
+                f"{result['mean_bytes']:>8} bytes", file=sys.stderr)
+  if args.output:
+    with open(args.output, 'w') as output:
+      json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,84 @@
+"""
+Measure how long the app factory takes to boot a worker or a test.
+
+    python -m benchmarks.startup --repeat 50 --database-uri postgresql://...
+
+Times create_app alone, create_app followed by the db.create_all() every
+boot used to run (a schema reflection round trip per table), the first
+request of a fresh app, and an app on an in-memory sqlite database that
+migrates itself, as a test fixture would. All times are wall clock, so
+database round trips count. Without --database-uri a migrated sqlite file
+is used.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from flaskr import create_app
+from migrations import migrate
+from models import db
+
+
+def wall_per_call(function, repeat):
+  """
+  This function returns the mean wall time of `function` in milliseconds.
+  """
+  started = time.perf_counter()
+  for _ in range(repeat):
+    function()
+  return round((time.perf_counter() - started) / repeat * 1e3, 2)
+
+
+def boot_paths(uri):
+  """
+  This function returns (name, boot) for the ways an app gets started.
+  """
+  def factory():
+    create_app({'SQLALCHEMY_DATABASE_URI': uri})
+
+  def factory_and_create_all():
+    app = create_app({'SQLALCHEMY_DATABASE_URI': uri})
+    with app.app_context():
+      db.create_all()
+
+  def first_request():
+    app = create_app({'SQLALCHEMY_DATABASE_URI': uri})
+    app.test_client().get('/categories')
+
+  def in_memory():
+    create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'AUTO_MIGRATE': True})
+
+  return [('create_app', factory),
+          ('create_app+create_all (previous boot)', factory_and_create_all),
+          ('create_app+first request', first_request),
+          ('create_app in-memory sqlite+migrate', in_memory)]
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog='python -m benchmarks.startup',
+                                   description=__doc__.strip().splitlines()[0])
+  parser.add_argument('--repeat', type=int, default=50)
+  parser.add_argument('--database-uri', default=None)
+  parser.add_argument('--output', default=None, help='write results as JSON')
+  args = parser.parse_args(argv)
+
+  results = []
+  with tempfile.TemporaryDirectory() as directory:
+    uri = args.database_uri or \
+          f'sqlite:///{os.path.join(directory, "bench.db")}'
+    app = create_app({'SQLALCHEMY_DATABASE_URI': uri})
+    migrate(db.get_engine(app), log=lambda message: None)
+    for name, boot in boot_paths(uri):
+      result = {'path': name, 'wall_ms': wall_per_call(boot, args.repeat)}
+      results.append(result)
+      print(f"{name:<40} {result['wall_ms']:>9.2f} ms", file=sys.stderr)
+  if args.output:
+    with open(args.output, 'w') as output:
+      json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+  main()
@@ -1,39 +1,222 @@
 import os
-from flask import Flask, request, abort, jsonify, request
+import click
+from flask import Flask, request, abort, request, Response, \
+                  stream_with_context, g, send_from_directory
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from sqlalchemy import func
+from decouple import config
 import random
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError, OperationalError
 
-from models import setup_db, Question, Category
+from models import setup_db, db, database_path, Question, QuestionStat, \
+                   STATS_NULL, question_listeners, version_listeners, \
+                   bump_version
+from migrations import migrate, remove_duplicate_questions, \
+                       reconcile_question_stats, MigrationError
+from .pagination import paginate, get_page_size, page_window, \
+                        next_page_cursor, CountCache
+from .categories import CategoryCache
+from .search import create_search_backend, load_questions, SearchCache, \
+                    parse_search_term
+from .quiz import QuestionPool, dump_seen_token, parse_quiz_request
+from .validation import validate_question, MAX_ID
+from .bulk import import_questions, export_questions, create_questions, \
+                  delete_questions, find_duplicate
+from .responses import ResponseCache
+from .metrics import Metrics
+from .serialization import jsonify, encode_rows, get_fields, with_columns, \
+                           project_rows, QUESTION_COLUMNS
+from .compression import Compressor
+from .suggest import SuggestIndex
+from .snapshot import Snapshot
+from .changes import ChangeFeed, ChangesExpired
+from .limits import RequestLimits
+from .profiling import RequestProfiler
 
 QUESTIONS_PER_PAGE = 10
+MAX_QUESTIONS_PER_PAGE = 100
+# non-GET endpoints that only read and can be served by the read replica
+READ_ONLY_ENDPOINTS = {'select_random_question'}
+# ?sort= values of /categories/<id>/questions, '-' prefix sorts descending
+CATEGORY_SORT_COLUMNS = {'id': None, 'difficulty': Question.difficulty}
 
 def create_app(test_config=None):
   # create and configure the app
   app = Flask(__name__)
-  setup_db(app)
+  app.config.from_mapping(
+    QUESTIONS_PER_PAGE=QUESTIONS_PER_PAGE,
+    MAX_QUESTIONS_PER_PAGE=MAX_QUESTIONS_PER_PAGE,
+    SEARCH_BACKEND='auto',
+    SECRET_KEY=config('SECRET_KEY', default='dev'),
+    BULK_BATCH_SIZE=1000,
+    BULK_MAX_ERRORS=100,
+    RESPONSE_CACHE_SIZE=1024,
+    METRICS_ENABLED=True,
+    SLOW_QUERY_THRESHOLD=0.5,
+    DB_POOL_SIZE=5,
+    DB_MAX_OVERFLOW=10,
+    DB_POOL_RECYCLE=1800,
+    DB_POOL_PRE_PING=True,
+    DB_STATEMENT_TIMEOUT=None,
+    DATABASE_READ_URI=config('DATABASE_READ_URI', default=None),
+    JSON_BACKEND='auto',
+    COMPRESS_MIN_SIZE=1024,
+    COMPRESS_LEVEL=6,
+    COMPRESS_BROTLI_QUALITY=4,
+    BATCH_MAX_SIZE=100,
+    SUGGEST_LIMIT=10,
+    MAX_SUGGEST_LIMIT=50,
+    SNAPSHOT_PATH=config('SNAPSHOT_PATH', default=None),
+    CHANGE_LOG_RETENTION=10000,
+    CHANGES_LIMIT=100,
+    CHANGES_WAIT=25,
+    CHANGES_MAX_WAIT=60,
+    CHANGES_POLL_INTERVAL=1.0,
+    CHANGES_SYNC_INTERVAL=1.0,
+    CHANGES_STREAM_DURATION=300,
+    CHANGES_HEARTBEAT=15,
+    AUTO_MIGRATE=False,
+    SEARCH_CACHE_SIZE=512,
+    SEARCH_CACHE_TTL=300,
+    SEARCH_CACHE_MAX_RESULTS=200,
+    # seconds per endpoint, None for no deadline; the change feed waits
+    # and the bulk endpoints stream, so they are left without one
+    ROUTE_DEADLINES={
+      'search_questions': 2.0,
+      'select_random_question': 1.0,
+      'get_question_changes': None,
+      'import_bulk_questions': None,
+      'export_bulk_questions': None
+    },
+    DEFAULT_DEADLINE=None,
+    # concurrent requests per endpoint and process, beyond them 503
+    ROUTE_CONCURRENCY={
+      'search_questions': 8,
+      'select_random_question': 16
+    },
+    SHED_RETRY_AFTER=1,
+    PROFILING_ENABLED=False,
+    # defaults to the 'profiles' folder of the instance path
+    PROFILE_DIR=config('PROFILE_DIR', default=None),
+    PROFILE_FORMAT='collapsed',
+    PROFILE_INTERVAL=0.005,
+    PROFILE_SAMPLE_RATE=0.0,
+    PROFILE_ENDPOINTS=None,
+    PROFILE_MAX_FILES=100,
+    PROFILE_TOKEN_MAX_AGE=3600
+  )
+  if test_config is not None:
+    app.config.from_mapping(test_config)
+  # test_config may point the app at another database (e.g. sqlite)
+  setup_db(app, app.config.get('SQLALCHEMY_DATABASE_URI', database_path))
+  # the schema is left to `flask migrate`, except for throwaway databases
+  # (e.g. in-memory sqlite) that ask for it with AUTO_MIGRATE
+  if app.config['AUTO_MIGRATE']:
+    with app.app_context():
+      migrate(db.get_engine(app), log=lambda message: None)
+  question_counts = CountCache('questions')
+  categories = CategoryCache()
+  question_pool = QuestionPool()
+  suggestions = SuggestIndex()
+  question_listeners.add(question_pool)
+  question_listeners.add(suggestions)
+  changes = ChangeFeed(app.config['CHANGES_POLL_INTERVAL'],
+                       app.config['CHANGES_SYNC_INTERVAL'])
+  version_listeners.add(changes)
+  # looked up by changes.replica_reads when caches are refilled
+  app.extensions['trivia_changes'] = changes
+  # registered first, so the other request hooks are profiled too
+  profiler = RequestProfiler(app) if app.config['PROFILING_ENABLED'] \
+             else None
+  metrics = Metrics(app) if app.config['METRICS_ENABLED'] else None
+  limits = RequestLimits(app)
+  compressor = Compressor(app)
+  if metrics is not None:
+    metrics.gauge('trivia_suggest_index_bytes',
+                  'Approximate memory used by the suggest index.',
+                  suggestions.memory_usage)
+  # one memory-mapped catalog shared by all worker processes, if configured
+  snapshot = None
+  if app.config['SNAPSHOT_PATH']:
+    snapshot = Snapshot(app)
+    version_listeners.add(snapshot)
+  responses = ResponseCache(app.config['RESPONSE_CACHE_SIZE'], compressor,
+                            snapshot.generation if snapshot else None)
+  search = SearchCache(create_search_backend(app),
+                       app.config['SEARCH_CACHE_SIZE'],
+                       app.config['SEARCH_CACHE_TTL'],
+                       app.config['SEARCH_CACHE_MAX_RESULTS'],
+                       snapshot.generation if snapshot else None)
+  if metrics is not None:
+    metrics.counter('trivia_search_cache_hits_total',
+                    'Searches answered from the search cache.',
+                    lambda: search.hits)
+    metrics.counter('trivia_search_cache_misses_total',
+                    'Searches that went to the search backend.',
+                    lambda: search.misses)
+    metrics.counter('trivia_search_cache_evictions_total',
+                    'Search cache entries evicted to stay within '
+                    'SEARCH_CACHE_SIZE.',
+                    lambda: search.evictions)
+    metrics.gauge('trivia_search_cache_entries',
+                  'Entries in the search cache.', lambda: len(search))
+    metrics.counter('trivia_requests_shed_total',
+                    'Requests turned away with a 503 by ROUTE_CONCURRENCY.',
+                    lambda: limits.shed)
+    metrics.counter('trivia_request_deadlines_exceeded_total',
+                    'Requests that ran out of time with a 504.',
+                    lambda: limits.timeouts)
   
   cors = CORS(app, resources={r"/*": {"origins": "*"}})
   
+  @app.before_request
+  def route_reads():
+    # reads go to the read replica when DATABASE_READ_URI is configured
+    g.use_replica = request.method == 'GET' or \
+                    request.endpoint in READ_ONLY_ENDPOINTS
+
+  @app.before_request
+  def sync_versions():
+    # writes of other worker processes invalidate the caches of this one
+    changes.sync()
+
   @app.after_request
   def after_request(response):
       response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,true')
       response.headers.add('Access-Control-Allow-Methods', 'GET,PATCH,POST,DELETE,OPTIONS')
       return response
   
+  def current_snapshot():
+    # the snapshot view to serve from, None to fall back to the database
+    return snapshot.current() if snapshot is not None else None
+
+  def snapshot_page(fetch, sort_column=None):
+    # like paginate, for fetch(after, offset, limit) reading snapshot rows
+    # in QUESTION_COLUMNS order; returns None if fetch can not serve it
+    per_page, after, offset = page_window(sort_column)
+    rows = fetch(after, offset, per_page + 1)
+    if rows is None:
+      return None
+    next_cursor = None
+    if len(rows) > per_page:
+      rows = rows[:per_page]
+      last = rows[-1]
+      next_cursor = next_page_cursor([last[0]] if sort_column is None
+                                     else [last[4], last[0]])
+    return rows, next_cursor
+
   @app.route('/categories', methods=['GET'])
+  @responses.cached
   def get_categories():
     """
     This function handles requesting all availabe categories.
     """
-    # get all categories
-    categories = Category.query.all()
+    # get all categories (served from the in-process cache)
+    formatted_categories = categories.all()
     # abort if no categories available
-    if not len(categories):
+    if not len(formatted_categories):
       abort(404)
-    # format categories
-    formatted_categories = {category.id: category.type for category in categories}
 
     return jsonify({
       'success': True,
@@ -42,31 +225,38 @@ def create_app(test_config=None):
     })
 
   @app.route('/questions', methods=['GET'])
+  @responses.cached
   def get_questions():
     """
     This function handles requests for paginated questions.
     """
-    # get all questions
-    questions = Question.query.all()
-    # get requested page number
-    page = request.args.get('page', 1, type=int)
-    # compute starting and ending question index 
-    start = (page - 1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
-    # format questions for specific page
-    formatted_questions = [question.format() for question in questions[start:end]]
-    if len(formatted_questions) == 0:
+    # only the requested columns (?fields=) are selected and encoded
+    fields = get_fields()
+    # get requested page (?page=) or the page after a cursor (?after=)
+    view = current_snapshot()
+    if view is not None:
+      questions, next_cursor = snapshot_page(view.question_page)
+      questions = project_rows(questions, fields)
+      total_questions = view.count
+      formatted_categories = view.all_categories()
+    else:
+      questions, next_cursor = paginate(
+        db.session.query(*with_columns(fields, Question.id)), Question.id)
+    if len(questions) == 0:
       abort(404)
+    # encode the rows of the page straight to JSON
+    formatted_questions = encode_rows(questions, fields)
 
-    # get all categories
-    categories = Category.query.all()
-    # format categories
-    formatted_categories = {category.id: category.type for category in categories}
+    if view is None:
+      total_questions = question_counts.get(Question.id)
+      # get all categories
+      formatted_categories = categories.all()
     current_category = None
     return jsonify({
       'success': True,
       'questions': formatted_questions,
-      'total_questions': len(questions),
+      'total_questions': total_questions,
+      'next_cursor': next_cursor,
       'categories': formatted_categories,
       'currentCategory': current_category
     })
@@ -76,6 +266,9 @@ def create_app(test_config=None):
     """
     This function handles deleting requested question.
     """
+    # no stored question can have a larger id
+    if question_id > MAX_ID:
+      abort(404)
     question = Question.query.get_or_404(question_id)
     question.delete()
 
@@ -88,78 +281,318 @@ def create_app(test_config=None):
     """
     This function handles inserting a new question.
     """
-    difficulties = [1, 2, 3, 4, 5]
-    categories = get_categories().json
-    
     data = request.get_json()
     # check if request data is valid
+    try:
+      values = validate_question(data, categories)
+    except ValueError as error:
+      abort(400, str(error))
+
+    # a retried request finds the stored copy instead of inserting again
+    question_id = find_duplicate(values[0], values[1])
+    duplicate = question_id is not None
+    if not duplicate:
+      question = Question(*values)
+      try:
+        question.insert()
+        question_id = question.id
+      except IntegrityError:
+        # the same question was inserted concurrently since the lookup
+        db.session.rollback()
+        question_id = find_duplicate(values[0], values[1])
+        duplicate = True
+      
+    return jsonify({
+      'success': True,
+      'id': question_id,
+      'duplicate': duplicate
+    })
+  
+  def batch_items(key):
+    # the list under `key` of a batch request body
+    data = request.get_json()
     if data is None:
       abort(400, 'Data is empty!')
-    elif ('question' or 
-          'answer' or 
-          'category' or 
-          'difficulty') not in data.keys():
+    elif not isinstance(data, dict) or not isinstance(data.get(key), list):
       abort(400, 'Invalid data format!')
-    elif len(data['question']) < 1:
-      abort(400, 'Question is empty!')
-    elif len(data['answer']) < 1:
-      abort(400, 'Answer is empty!')
-    elif data['category'] not in categories.values():
-      abort(400, 'Invalid category value!')
-    elif data['difficulty'] not in difficulties:
-      abort(400, 'Invalid difficulty value!')  
-    else:
-      question = Question(data['question'],
-                          data['answer'],
-                          data['category'],
-                          data['difficulty'])
-      
-      question.insert()
-      
+    elif not data[key]:
+      abort(400, 'Batch is empty!')
+    elif len(data[key]) > app.config['BATCH_MAX_SIZE']:
+      abort(400, f"Batch has more than {app.config['BATCH_MAX_SIZE']} items!")
+    return data[key]
+
+  @app.route('/questions/batch', methods=['POST'])
+  def add_questions_batch():
+    """
+    This function handles inserting a list of questions with one
+    statement and one commit, reporting the outcome of every item.
+    """
+    items = batch_items('questions')
+    results = []
+    rows = []
+    for index, item in enumerate(items):
+      try:
+        rows.append(validate_question(item, categories))
+        results.append({'index': index, 'success': True})
+      except ValueError as error:
+        results.append({'index': index, 'success': False,
+                        'message': str(error)})
+    created = iter(create_questions(rows))
+    inserted = 0
+    for result in results:
+      if result['success']:
+        result['id'], new = next(created)
+        inserted += new
+        if not new:
+          result['duplicate'] = True
+
     return jsonify({
-      'success': True
+      'success': True,
+      'inserted': inserted,
+      'duplicates': len(rows) - inserted,
+      'rejected': len(items) - len(rows),
+      'results': results
     })
-  
+
+  @app.route('/questions/batch', methods=['DELETE'])
+  def delete_questions_batch():
+    """
+    This function handles deleting a list of questions with one
+    statement and one commit, reporting the outcome of every id.
+    """
+    items = batch_items('ids')
+    if any(type(question_id) is int and question_id > MAX_ID
+           for question_id in items):
+      abort(422)
+    valid = [question_id for question_id in items
+             if type(question_id) is int and question_id > 0]
+    deleted = delete_questions(set(valid))
+    results = []
+    for question_id in items:
+      if type(question_id) is not int or question_id < 1:
+        results.append({'id': question_id, 'success': False,
+                        'message': 'Invalid id value!'})
+      elif question_id not in deleted:
+        results.append({'id': question_id, 'success': False,
+                        'message': 'resource not found!'})
+      else:
+        results.append({'id': question_id, 'success': True})
+
+    return jsonify({
+      'success': True,
+      'deleted': len(deleted),
+      'results': results
+    })
+
+  def bulk_format():
+    # an explicit ?format= wins over the request content type
+    format = request.args.get('format')
+    if format is None:
+      format = 'csv' if request.mimetype == 'text/csv' else 'ndjson'
+    if format not in ('ndjson', 'csv'):
+      abort(400, 'Invalid format value!')
+    return format
+
+  @app.route('/questions/bulk', methods=['POST'])
+  def import_bulk_questions():
+    """
+    This function handles importing questions streamed as NDJSON or CSV.
+    """
+    format = bulk_format()
+    lines = (line.decode('utf-8') for line in request.stream)
+    inserted, duplicates, rejected, errors = import_questions(
+      lines, format, categories, app.config['BULK_BATCH_SIZE'],
+      app.config['BULK_MAX_ERRORS'])
+    return jsonify({
+      'success': True,
+      'inserted': inserted,
+      'duplicates': duplicates,
+      'rejected': rejected,
+      'errors': errors
+    })
+
+  @app.route('/questions/bulk', methods=['GET'])
+  def export_bulk_questions():
+    """
+    This function handles streaming all questions as NDJSON or CSV.
+    """
+    format = bulk_format()
+    mimetype = 'text/csv' if format == 'csv' else 'application/x-ndjson'
+    chunks = export_questions(format, app.config['BULK_BATCH_SIZE'])
+    return Response(stream_with_context(chunks), mimetype=mimetype)
+
   @app.route('/questions/search', methods=['POST'])
   def search_questions():
     """
-    This function handles requested search for questions.
+    This function handles requested search for questions
+    and answers, ranked by relevance and paginated.
     """
     # get search term and category if selected
-    search_term = request.get_json()['searchTerm']
+    try:
+      search_term = parse_search_term(request.get_json())
+    except ValueError as error:
+      abort(400, str(error))
+    fields = get_fields()
     current_category = request.args.get('category', None, type=int)
-    # check if a category is selected or not
-    if current_category is None:
-      questions = Question.query\
-                  .filter(Question.question.ilike(f'%{search_term}%')).all()
-    else:
-      questions = Question.query\
-                  .filter(Question.question.ilike(f'%{search_term}%'))\
-                  .filter(Question.category == current_category).all()
+    # get requested page of ranked matches
+    per_page = get_page_size()
+    page = request.args.get('page', 1, type=int)
+    if page < 1:
+      abort(404)
+    question_ids, total_questions = search.search(search_term,
+                                                  current_category,
+                                                  per_page,
+                                                  (page - 1) * per_page)
     # format questions
-    formatted_questions = [question.format() for question in questions]
+    formatted_questions = encode_rows(load_questions(question_ids, fields),
+                                      fields)
     return jsonify({
       'success': True,
       'questions': formatted_questions,
-      'total_questions': len(formatted_questions)
+      'total_questions': total_questions
     })
  
+  @app.route('/questions/suggest', methods=['GET'])
+  def suggest_questions():
+    """
+    This function handles autocomplete requests: words completing the
+    typed prefix and questions using them, optionally within a category.
+    """
+    prefix = request.args.get('prefix', '')
+    if not prefix.strip():
+      abort(400, 'Prefix is empty!')
+    current_category = request.args.get('category', None, type=int)
+    limit = request.args.get('limit', app.config['SUGGEST_LIMIT'], type=int)
+    if limit < 1:
+      abort(400, 'Invalid limit value!')
+    terms, questions = suggestions.suggest(prefix,
+                                           current_category,
+                                           min(limit,
+                                               app.config['MAX_SUGGEST_LIMIT']))
+    return jsonify({
+      'success': True,
+      'terms': terms,
+      'questions': questions
+    })
+
+  @app.route('/questions/changes', methods=['GET'])
+  def get_question_changes():
+    """
+    This function handles requests for the question inserts, updates and
+    deletes recorded after the `since` seq: as a long-poll waiting up to `wait`
+    seconds for the first ones, or as a Server-Sent Events stream.
+    """
+    since = request.args.get('since', None, type=int)
+    if since is None:
+      # EventSource sends the id of the last event it got on reconnect
+      since = request.headers.get('Last-Event-ID', None, type=int)
+    if since is not None and since < 0:
+      abort(400, 'Invalid since value!')
+    wait = request.args.get('wait', app.config['CHANGES_WAIT'], type=int)
+    if wait < 0:
+      abort(400, 'Invalid wait value!')
+    limit = app.config['CHANGES_LIMIT']
+
+    if request.accept_mimetypes.best_match(['application/json',
+                                            'text/event-stream']) == \
+       'text/event-stream':
+      if since is None:
+        since = changes.latest()
+      events = changes.stream(since, limit,
+                              app.config['CHANGES_STREAM_DURATION'],
+                              app.config['CHANGES_HEARTBEAT'])
+      return Response(stream_with_context(events),
+                      mimetype='text/event-stream',
+                      headers={'Cache-Control': 'no-cache'})
+
+    # without a seq, clients learn where the feed starts
+    if since is None:
+      formatted_changes = []
+      last_seq = changes.latest()
+    else:
+      try:
+        formatted_changes = changes.wait(since, limit,
+                                         min(wait,
+                                             app.config['CHANGES_MAX_WAIT']))
+      except ChangesExpired:
+        abort(410)
+      last_seq = formatted_changes[-1]['seq'] if formatted_changes else since
+    return jsonify({
+      'success': True,
+      'changes': formatted_changes,
+      'last_seq': last_seq
+    })
+
   @app.route('/categories/<int:cat_id>/questions', methods=['GET'])
+  @responses.cached
   def get_category_questions(cat_id):
     """
-    This function handles requests for questions based on on a category.
+    This function handles requests for paginated questions based on
+    a category, optionally filtered by difficulty and sorted.
     """
     # check category availability
-    current_category = Category.query.get_or_404(cat_id)
-    questions = Question.query\
-                .filter(Question.category == str(cat_id))\
-                .all()
-    formatted_questions = [question.format() for question in questions]
+    view = current_snapshot()
+    if view is not None:
+      category_type = view.all_categories().get(cat_id)
+      current_category = None if category_type is None \
+                         else {'id': cat_id, 'type': category_type}
+    else:
+      current_category = categories.get(cat_id)
+    if current_category is None:
+      abort(404)
+    # get requested filters and sort order
+    difficulty = request.args.get('difficulty', None, type=int)
+    min_difficulty = request.args.get('min_difficulty', difficulty, type=int)
+    max_difficulty = request.args.get('max_difficulty', difficulty, type=int)
+    sort = request.args.get('sort', 'id')
+    if sort.lstrip('-') not in CATEGORY_SORT_COLUMNS:
+      abort(400, 'Invalid sort value!')
+    sort_column = CATEGORY_SORT_COLUMNS[sort.lstrip('-')]
+    fields = get_fields()
+
+    page = None
+    if view is not None:
+      page = snapshot_page(
+        lambda after, offset, limit: view.category_page(
+          cat_id, min_difficulty, max_difficulty, sort_column is not None,
+          sort.startswith('-'), after, offset, limit),
+        sort_column)
+    if page is None:
+      criteria = [Question.category == cat_id]
+      if min_difficulty is not None:
+        criteria.append(Question.difficulty >= min_difficulty)
+      if max_difficulty is not None:
+        criteria.append(Question.difficulty <= max_difficulty)
+      # the cursor of the next page is read from the sort columns
+      columns = with_columns(fields, Question.id, sort_column)
+      page = paginate(db.session.query(*columns).filter(*criteria),
+                      Question.id,
+                      sort_column,
+                      descending=sort.startswith('-'))
+    else:
+      page = project_rows(page[0], fields), page[1]
+    questions, next_cursor = page
+    formatted_questions = encode_rows(questions, fields)
+
+    # per-difficulty counts of the whole category in one grouped query
+    if view is not None:
+      difficulty_counts = view.difficulty_counts(cat_id)
+    else:
+      difficulty_counts = dict(db.session.query(Question.difficulty,
+                                                func.count(Question.id))
+                               .filter(Question.category == cat_id)
+                               .filter(Question.difficulty.isnot(None))
+                               .group_by(Question.difficulty))
+    total_questions = sum(count for value, count in difficulty_counts.items()
+                          if (min_difficulty is None or value >= min_difficulty)
+                          and (max_difficulty is None or value <= max_difficulty))
     return jsonify({
       'success': True,
       'questions': formatted_questions,
-      'total_questions': len(formatted_questions),
-      'current_category': current_category.format()
+      'total_questions': total_questions,
+      'next_cursor': next_cursor,
+      'difficulty_counts': difficulty_counts,
+      'current_category': current_category
     })
 
   @app.route('/quizzes', methods=['POST'])
@@ -169,43 +602,200 @@ def create_app(test_config=None):
     based on a category if specified, and previous questions
     to eleminate repetition.
     """
-    data = request.get_json()
-    # check if request data is valid 
-    if data is not None:
-      # check dictionary is in correct format
-      if ('previous_questions' or 'quiz_category') not in data.keys():
-        abort(400, f'{data},\'previous_questions\' and/or \'quiz_category\' are missing!')
-
-      previous_questions = data['previous_questions']
-      quiz_category = data['quiz_category']
-      # check all values are valid
-      if quiz_category is None or not isinstance(quiz_category, dict):
-        abort(400, f'{data},\'quiz_category\' is None or not a dictionary!')
-      elif not isinstance(previous_questions, list):
-        abort(400, f'{previous_questions}, \'previous_questions\' is not a list!')
-      elif 'id' not in quiz_category.keys():
-        abort(400, f'{quiz_category}, \'id\' key is missing!')
-      elif type(quiz_category['id']) is not int:
-        abort(400, f'{quiz_category}, \'id\' is not an integer!')
-      elif quiz_category['id'] == 0:
-        question = Question.query\
-                  .filter(Question.id.notin_(previous_questions))\
-                  .order_by(func.random()).first()
-      else:
-        question = Question.query\
-                  .filter(Question.category == str(quiz_category['id']))\
-                  .filter(Question.id.notin_(previous_questions))\
-                  .order_by(func.random()).first()
-      
-      formatted_question = question.format() if question is not None else None
+    try:
+      category, seen = parse_quiz_request(request.get_json(),
+                                          app.config['SECRET_KEY'])
+    except ValueError as error:
+      abort(400, str(error))
+    view = current_snapshot()
+    if view is not None:
+      # the snapshot holds whole rows, no query needed
+      row = view.draw(category, seen)
+      formatted_question = None if row is None else \
+        dict(zip([column.key for column in QUESTION_COLUMNS], row))
     else:
-      abort(400, 'No data provided!')
+      # draw an unseen id from the in-memory pool, then fetch that row
+      question = None
+      question_id = question_pool.draw(category, seen)
+      while question_id is not None:
+        question = Question.query.get(question_id)
+        if question is not None:
+          break
+        # deleted by another worker since the pool was built
+        question_pool.invalidate()
+        seen.add(question_id)
+        question_id = question_pool.draw(category, seen)
+      formatted_question = question.format() if question is not None else None
+
+    if formatted_question is not None:
+      seen.add(formatted_question['id'])
+
+    return jsonify({
+      'success': True,
+      'question': formatted_question,
+      'seen_token': dump_seen_token(seen, app.config['SECRET_KEY'])
+    })
+
+  @app.route('/stats', methods=['GET'])
+  def get_stats():
+    """
+    This function handles requests for question counts per category,
+    per difficulty and overall, read from the question_stats counters.
+    The counters are one small indexed read, so they are not cached.
+    """
+    total_questions = 0
+    category_counts = {}
+    difficulty_counts = {}
+    for category, difficulty, count in db.session.query(
+        QuestionStat.category, QuestionStat.difficulty, QuestionStat.count)\
+        .filter(QuestionStat.count > 0):
+      total_questions += count
+      if category != STATS_NULL:
+        category_counts[category] = category_counts.get(category, 0) + count
+      if difficulty != STATS_NULL:
+        difficulty_counts[difficulty] = difficulty_counts.get(difficulty, 0) \
+                                        + count
 
     return jsonify({
       'success': True,
-      'question': formatted_question
+      'total_questions': total_questions,
+      'category_counts': category_counts,
+      'difficulty_counts': difficulty_counts
     })
 
+  @app.route('/metrics', methods=['GET'])
+  def get_metrics():
+    """
+    This function handles requests for metrics in Prometheus text format.
+    """
+    if metrics is None:
+      abort(404)
+    return metrics.render()
+
+  def check_profile_access():
+    # the profile endpoints need PROFILING_ENABLED and a profile token
+    if profiler is None:
+      abort(404)
+    if not profiler.authorized():
+      abort(403)
+
+  @app.route('/admin/profiles', methods=['GET'])
+  def list_profiles():
+    """
+    This function handles listing the stored request profiles, newest first.
+    """
+    check_profile_access()
+    return jsonify({
+      'success': True,
+      'profiles': profiler.profiles()
+    })
+
+  @app.route('/admin/profiles/<profile_id>', methods=['GET'])
+  def download_profile(profile_id):
+    """
+    This function handles downloading a stored request profile.
+    """
+    check_profile_access()
+    name = profiler.find(profile_id)
+    if name is None:
+      abort(404)
+    return send_from_directory(profiler.directory, name, as_attachment=True,
+                               mimetype='text/plain'
+                               if name.endswith('.collapsed')
+                               else 'application/octet-stream')
+
+  @app.cli.command('migrate')
+  @click.option('--batch-size', default=1000, show_default=True,
+                help='Rows per backfill transaction.')
+  def migrate_command(batch_size):
+    """
+    Apply pending schema migrations.
+    """
+    try:
+      applied = migrate(db.get_engine(app), batch_size, log=click.echo)
+    except MigrationError as error:
+      raise click.ClickException(str(error))
+    click.echo(f'{len(applied)} migrations applied.')
+
+  @app.cli.command('dedup-questions')
+  @click.option('--batch-size', default=1000, show_default=True,
+                help='Deleted rows per transaction.')
+  @click.option('--dry-run', is_flag=True,
+                help='Only list the duplicates.')
+  @click.option('--apply', is_flag=True,
+                help='Delete the duplicates.')
+  def dedup_questions_command(batch_size, dry_run, apply):
+    """
+    List (--dry-run) or remove (--apply) questions whose normalized
+    question and answer duplicate an older question.
+    """
+    if dry_run == apply:
+      raise click.UsageError('Pass either --dry-run or --apply.')
+    count = remove_duplicate_questions(db.get_engine(app), batch_size,
+                                       log=click.echo, dry_run=dry_run)
+    if count and not dry_run:
+      bump_version('questions')
+    click.echo(f"{count} duplicates {'found' if dry_run else 'removed'}.")
+
+  @app.cli.command('build-snapshot')
+  def build_snapshot_command():
+    """
+    Write the catalog snapshot at SNAPSHOT_PATH, e.g. before workers start.
+    """
+    if snapshot is None:
+      raise click.UsageError('SNAPSHOT_PATH is not set.')
+    if not snapshot.rebuild():
+      raise click.ClickException('Another worker is writing the snapshot.')
+    click.echo(f'Snapshot written to {snapshot.path}.')
+
+  @app.cli.command('reconcile-stats')
+  def reconcile_stats_command():
+    """
+    Rebuild the question counters behind /stats from the questions table.
+    """
+    reconcile_question_stats(db.get_engine(app))
+    bump_version('questions')
+    click.echo('Question stats rebuilt.')
+
+  @app.cli.command('import-questions')
+  @click.argument('file', type=click.File('r'))
+  @click.option('--format', type=click.Choice(['ndjson', 'csv']),
+                help='Defaults to csv for .csv files, ndjson otherwise.')
+  def import_questions_command(file, format):
+    """
+    Import questions from an NDJSON or CSV file ('-' for stdin).
+    """
+    if format is None:
+      format = 'csv' if file.name.endswith('.csv') else 'ndjson'
+    inserted, duplicates, rejected, errors = import_questions(
+      file, format, categories, app.config['BULK_BATCH_SIZE'],
+      app.config['BULK_MAX_ERRORS'])
+    for error in errors:
+      click.echo(f"line {error['line']}: {error['message']}", err=True)
+    click.echo(f'{inserted} questions imported, {duplicates} duplicates '
+               f'skipped, {rejected} rejected.')
+
+  @app.cli.command('export-questions')
+  @click.argument('file', type=click.File('w'), default='-')
+  @click.option('--format', type=click.Choice(['ndjson', 'csv']),
+                default='ndjson')
+  def export_questions_command(file, format):
+    """
+    Export all questions as NDJSON or CSV to a file (stdout by default).
+    """
+    for chunk in export_questions(format, app.config['BULK_BATCH_SIZE']):
+      file.write(chunk)
+
+  @app.cli.command('profile-token')
+  def profile_token_command():
+    """
+    Print a token for the X-Profile-Token header of profiled requests and
+    of the profile endpoints.
+    """
+    if profiler is None:
+      raise click.ClickException('PROFILING_ENABLED is off.')
+    click.echo(profiler.token())
+
   @app.errorhandler(404)
   def not_found(error):
     return jsonify({
@@ -214,6 +804,47 @@ def create_app(test_config=None):
       'message': 'resource not found!'
     }), 404
   
+  @app.errorhandler(403)
+  def forbidden(error):
+    return jsonify({
+      'success': False,
+      'error': 403,
+      'message': 'forbidden!'
+    }), 403
+
+  @app.errorhandler(503)
+  def service_unavailable(error):
+    response = jsonify({
+      'success': False,
+      'error': 503,
+      'message': 'server busy, retry later!'
+    })
+    response.headers['Retry-After'] = str(app.config['SHED_RETRY_AFTER'])
+    return response, 503
+
+  @app.errorhandler(504)
+  def gateway_timeout(error):
+    return jsonify({
+      'success': False,
+      'error': 504,
+      'message': 'request took too long!'
+    }), 504
+
+  @app.errorhandler(OperationalError)
+  def database_error(error):
+    # statements cancelled at the request deadline, anything else is a 500
+    if not limits.cancelled(error):
+      raise error
+    return gateway_timeout(error)
+
+  @app.errorhandler(410)
+  def gone(error):
+    return jsonify({
+      'success': False,
+      'error': 410,
+      'message': 'changes expired, reload!'
+    }), 410
+
   @app.errorhandler(422)
   def unprocessable(error):
     return jsonify({
@@ -0,0 +1,250 @@
+import csv
+import io
+import json
+
+from sqlalchemy import text, bindparam
+
+from models import db, Question, bump_version, record_question_changes, \
+                   notify_questions, update_question_stats, content_hash
+from .validation import validate_question, QUESTION_FIELDS
+
+EXPORT_FIELDS = ('id',) + QUESTION_FIELDS
+# the stored columns of a new question
+INSERT_FIELDS = QUESTION_FIELDS + ('content_hash',)
+
+
+def read_rows(lines, format):
+  """
+  This function parses an iterable of text lines as NDJSON or CSV and yields
+  (line_number, data) pairs. Lines that can not be parsed yield None as data.
+  """
+  if format == 'csv':
+    reader = csv.DictReader(lines)
+    for row in reader:
+      # csv values are strings, difficulty has to be an integer
+      if (row.get('difficulty') or '').strip().isdigit():
+        row['difficulty'] = int(row['difficulty'])
+      yield reader.line_num, row
+  else:
+    for line_number, line in enumerate(lines, start=1):
+      if not line.strip():
+        continue
+      try:
+        yield line_number, json.loads(line)
+      except ValueError:
+        yield line_number, None
+
+
+def with_hash(row):
+  # a (question, answer, category, difficulty) tuple plus its content hash
+  return tuple(row) + (content_hash(row[0], row[1]),)
+
+
+def existing_ids(hashes):
+  """
+  This function looks up content hashes in the unique index and returns
+  a {hash: id} dict of those already stored.
+  """
+  if not hashes:
+    return {}
+  return dict(db.session.query(Question.content_hash, Question.id)
+              .filter(Question.content_hash.in_(list(hashes))))
+
+
+def find_duplicate(question, answer):
+  """
+  This function returns the id of a stored question with the same
+  content, or None.
+  """
+  hash = content_hash(question, answer)
+  return existing_ids([hash]).get(hash)
+
+
+def insert_batch(rows):
+  """
+  This function inserts (question, answer, category, difficulty) tuples
+  in one statement, skipping duplicates of stored or earlier rows:
+  COPY into a staging table on PostgreSQL, executemany elsewhere.
+  Counts the inserted rows in the question stats and returns their number.
+  """
+  rows = [with_hash(row) for row in rows]
+  connection = db.session.connection()
+  columns = ', '.join(INSERT_FIELDS)
+  if connection.dialect.name == 'postgresql':
+    # COPY can not skip conflicts, so it fills a staging table first
+    connection.execute(text(
+      'CREATE TEMPORARY TABLE IF NOT EXISTS questions_import '
+      '(question varchar, answer varchar, category integer, '
+      'difficulty integer, content_hash varchar) ON COMMIT DELETE ROWS'))
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(f'COPY questions_import ({columns}) '
+                       'FROM STDIN WITH (FORMAT csv)', buffer)
+    inserted = connection.execute(text(
+      f'INSERT INTO questions ({columns}) '
+      f'SELECT {columns} FROM questions_import '
+      'ON CONFLICT (content_hash) DO NOTHING '
+      'RETURNING category, difficulty')).fetchall()
+  else:
+    # executemany can not return rows, so the duplicates are left out first
+    stored = existing_ids({row[-1] for row in rows})
+    new_rows = {}
+    for row in rows:
+      if row[-1] not in stored:
+        new_rows.setdefault(row[-1], row)
+    if new_rows:
+      connection.execute(text(
+        f"INSERT INTO questions ({columns}) "
+        f"VALUES ({', '.join(':' + field for field in INSERT_FIELDS)}) "
+        'ON CONFLICT (content_hash) DO NOTHING'),
+        [dict(zip(INSERT_FIELDS, row)) for row in new_rows.values()])
+    inserted = [row[2:4] for row in new_rows.values()]
+  update_question_stats(inserted, 1)
+  return len(inserted)
+
+
+def create_questions(rows):
+  """
+  This function inserts (question, answer, category, difficulty) tuples
+  with one multi-row INSERT and one commit. Duplicates of stored or
+  earlier rows are not inserted. Returns an (id, created) pair for each
+  row, with the id of the stored copy when created is False.
+  """
+  rows = [with_hash(row) for row in rows]
+  ids = existing_ids({row[-1] for row in rows})
+  new_rows = {}
+  for row in rows:
+    if row[-1] not in ids:
+      new_rows.setdefault(row[-1], row)
+  created = {}
+  if new_rows:
+    params = {}
+    values = []
+    for index, row in enumerate(new_rows.values()):
+      names = [f'{field}_{index}' for field in INSERT_FIELDS]
+      params.update(zip(names, row))
+      values.append(f"({', '.join(':' + name for name in names)})")
+    # rows inserted concurrently since the lookup are skipped, not failed;
+    # RETURNING needs PostgreSQL or SQLite 3.35+
+    result = db.session.execute(text(
+      f"INSERT INTO questions ({', '.join(INSERT_FIELDS)}) "
+      f"VALUES {', '.join(values)} "
+      'ON CONFLICT (content_hash) DO NOTHING RETURNING id, content_hash'),
+      params)
+    created = {hash: question_id for question_id, hash in result}
+    changes = [('insert', dict(zip(('id',) + QUESTION_FIELDS,
+                                   (created[hash],) + new_rows[hash][:-1])))
+               for hash in sorted(created, key=created.get)]
+    if changes:
+      record_question_changes(changes)
+      update_question_stats([new_rows[hash][2:4] for hash in created], 1)
+    db.session.commit()
+    if changes:
+      bump_version('questions')
+      notify_questions(changes)
+    ids.update(created)
+    ids.update(existing_ids(set(new_rows) - set(created)))
+  pairs = []
+  for row in rows:
+    hash = row[-1]
+    pairs.append((ids[hash], created.pop(hash, None) is not None))
+  return pairs
+
+
+def delete_questions(ids):
+  """
+  This function deletes questions by id with one statement and one commit,
+  and returns the set of ids that existed.
+  """
+  if not ids:
+    return set()
+  result = db.session.execute(
+    text('DELETE FROM questions WHERE id IN :ids '
+         'RETURNING id, category, difficulty')
+    .bindparams(bindparam('ids', expanding=True)),
+    {'ids': list(ids)})
+  rows = result.fetchall()
+  deleted = {row[0] for row in rows}
+  changes = [('delete', {'id': question_id}) for question_id in sorted(deleted)]
+  if changes:
+    record_question_changes(changes)
+    update_question_stats([row[1:] for row in rows], -1)
+  db.session.commit()
+  if changes:
+    bump_version('questions')
+    notify_questions(changes)
+  return deleted
+
+
+def import_questions(lines, format, categories, batch_size, max_errors):
+  """
+  This function validates and inserts questions read from `lines`,
+  committing every `batch_size` rows.
+  Rows duplicating stored or earlier questions are skipped, so importing
+  a file again is a no-op.
+  Returns the number of inserted rows, the number of duplicates, the
+  number of rejected rows and the first `max_errors` errors as
+  {'line', 'message'} dicts.
+  """
+  inserted = duplicates = rejected = 0
+  errors = []
+  batch = []
+  try:
+    for line_number, data in read_rows(lines, format):
+      try:
+        if data is None:
+          raise ValueError('Invalid data format!')
+        batch.append(validate_question(data, categories))
+      except ValueError as error:
+        rejected += 1
+        if len(errors) < max_errors:
+          errors.append({'line': line_number, 'message': str(error)})
+        continue
+      if len(batch) >= batch_size:
+        inserted, duplicates = import_batch(batch, inserted, duplicates)
+        batch = []
+    if batch:
+      inserted, duplicates = import_batch(batch, inserted, duplicates)
+  finally:
+    if inserted:
+      bump_version('questions')
+      notify_questions([('reset', None)])
+  return inserted, duplicates, rejected, errors
+
+
+def import_batch(batch, inserted, duplicates):
+  # insert and commit one batch of an import, add it to the running totals
+  count = insert_batch(batch)
+  if count:
+    # COPY does not return ids, feed readers reload instead
+    record_question_changes([('reset', None)])
+  db.session.commit()
+  return inserted + count, duplicates + len(batch) - count
+
+
+def export_questions(format, batch_size):
+  """
+  This function yields every question as NDJSON or CSV text chunks,
+  reading them through a server-side cursor so memory use stays flat.
+  """
+  rows = db.session.query(*[getattr(Question, field)
+                            for field in EXPORT_FIELDS])\
+         .order_by(Question.id)\
+         .execution_options(stream_results=True)\
+         .yield_per(batch_size)
+  buffer = io.StringIO()
+  writer = csv.writer(buffer)
+  if format == 'csv':
+    writer.writerow(EXPORT_FIELDS)
+  for row in rows:
+    if format == 'csv':
+      writer.writerow(row)
+    else:
+      buffer.write(json.dumps(dict(zip(EXPORT_FIELDS, row))) + '\n')
+    if buffer.tell() >= 1 << 16:
+      yield buffer.getvalue()
+      buffer.seek(0)
+      buffer.truncate()
+  yield buffer.getvalue()
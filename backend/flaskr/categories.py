@@ -0,0 +1,67 @@
+from models import Category, data_versions, primary_reads
+
+
+class CategoryCache:
+  """
+  Keeps every category in memory, indexed by id and by type, and reloads
+  them only when the categories data version changes or `invalidate` is called.
+  """
+
+  def __init__(self):
+    self.version = None
+    self.by_id = {}
+    self.by_type = {}
+
+  def invalidate(self):
+    self.version = None
+
+  def refresh(self):
+    if self.version == data_versions['categories']:
+      return
+    version = data_versions['categories']
+    with primary_reads():
+      self.load([(category.id, category.type)
+                 for category in Category.query.all()], version)
+
+  def load(self, categories, version):
+    """
+    This function replaces the cached categories with (id, type) pairs
+    loaded at the given data version.
+    """
+    # swap whole dicts so concurrent readers never see a half-built index
+    self.by_id = {cat_id: type for cat_id, type in categories}
+    self.by_type = {type.lower(): cat_id for cat_id, type in categories}
+    self.version = version
+
+  def all(self):
+    """
+    This function returns a {id: type} dict of all categories.
+    """
+    self.refresh()
+    return self.by_id
+
+  def get(self, cat_id):
+    """
+    This function returns the formatted category of the given id or None.
+    """
+    self.refresh()
+    if cat_id not in self.by_id:
+      return None
+    return {'id': cat_id, 'type': self.by_id[cat_id]}
+
+  def resolve(self, value):
+    """
+    This function maps a category id, numeric string or type name
+    to a category id, or None if no such category exists.
+    """
+    self.refresh()
+    if isinstance(value, bool):
+      return None
+    if isinstance(value, str):
+      if value.isdigit():
+        value = int(value)
+      else:
+        return self.by_type.get(value.lower())
+    if not isinstance(value, int):
+      return None
+    return value if value in self.by_id else None
@@ -0,0 +1,199 @@
+import json
+import threading
+import time
+from contextlib import nullcontext
+
+from flask import current_app, g, has_app_context, has_request_context
+from sqlalchemy import func, text
+
+from models import db, QuestionChange, bump_version, primary_reads, \
+                   READ_BIND, CHANGE_LOG_LAST
+
+
+class ChangesExpired(Exception):
+  """
+  The requested seq is older than the retained change log (or newer than
+  its end), so the changes after it can not be listed.
+  """
+
+
+class ChangeFeed:
+  """
+  Reads the question change log (see models.record_question_changes).
+  Waiting readers are woken right away by writes of this process and
+  poll every `poll_interval` seconds for writes of other processes.
+  `sync` brings the questions data version in line with the log, at most
+  every `sync_interval` seconds. `replica_current` tells whether the read
+  replica has replayed the log up to the last write known here.
+  Apps without a SQLAlchemy session (async_api) report their writes to
+  `adopt` and the seqs they read to `observe` instead.
+  """
+
+  def __init__(self, poll_interval, sync_interval):
+    self.poll_interval = poll_interval
+    self.sync_interval = sync_interval
+    self.condition = threading.Condition()
+    self.lock = threading.Lock()
+    # the last seq up to which every write is known to this process
+    self.seen = None
+    # the newest seq known to this process, and the newest on the replica
+    self.known = 0
+    self.replayed = 0
+    self.next_sync = 0.0
+
+  def version_bumped(self, table):
+    if table == 'questions':
+      if has_app_context():
+        self.adopt(*db.session.info.get('change_log', (None, None)))
+      with self.condition:
+        self.condition.notify_all()
+
+  def adopt(self, previous, last):
+    """
+    This function takes note of a committed write of this process, given
+    the last seq of the log before and after it.
+    """
+    with self.lock:
+      # seen moves on only if the write directly followed it
+      if previous is not None and previous == self.seen:
+        self.seen = last
+      if last is not None:
+        self.known = max(self.known, last)
+
+  def sync_due(self):
+    """
+    This function tells whether `sync_interval` seconds passed since the
+    last sync, and starts the next interval if so.
+    """
+    now = time.monotonic()
+    with self.lock:
+      if now < self.next_sync:
+        return False
+      self.next_sync = now + self.sync_interval
+      return True
+
+  def sync(self):
+    """
+    This function brings the questions data version in line with the
+    change log, at most every `sync_interval` seconds.
+    """
+    if self.sync_due():
+      self.observe(db.session.query(
+        func.coalesce(func.max(QuestionChange.seq), 0)).scalar())
+
+  def observe(self, latest):
+    """
+    This function bumps the questions data version when the change log
+    went past the last seq seen here, i.e. another worker process wrote
+    questions, so every cache keyed by the version reloads. The writer
+    published its write already, so version listeners (such as the
+    snapshot generation shared by all workers) are left alone.
+    """
+    with self.lock:
+      seen = self.seen
+      self.seen = latest if seen is None else max(seen, latest)
+      self.known = max(self.known, latest)
+    if seen is not None and latest > seen:
+      bump_version('questions', notify=False)
+      with self.condition:
+        self.condition.notify_all()
+
+  def replica_current(self):
+    """
+    This function tells whether the reads of the current request may
+    refill caches from the read replica: only once it has replayed the
+    change log up to the newest write known to this process. A lagging
+    replica would leave its older rows cached under the new data version
+    until the next write.
+    """
+    if not g.get('use_replica') or \
+       READ_BIND not in (current_app.config.get('SQLALCHEMY_BINDS') or {}):
+      return True
+    with self.lock:
+      if self.replayed >= self.known:
+        return True
+    # routed to the replica like the other reads of the request
+    replayed = db.session.execute(text(CHANGE_LOG_LAST)).scalar()
+    with self.lock:
+      self.replayed = max(self.replayed, replayed)
+      return self.replayed >= self.known
+
+  def latest(self):
+    """
+    This function returns the seq of the last recorded change (0 if none).
+    """
+    try:
+      return db.session.query(func.max(QuestionChange.seq)).scalar() or 0
+    finally:
+      # give the connection back to the pool between polls
+      db.session.close()
+
+  def read(self, since, limit):
+    """
+    This function returns up to `limit` changes after seq `since` as
+    formatted dicts. Raises ChangesExpired if changes after `since` may
+    have been dropped already.
+    """
+    try:
+      oldest, latest = db.session.query(func.min(QuestionChange.seq),
+                                        func.max(QuestionChange.seq)).one()
+      if since > (latest or 0) or (oldest is not None and since < oldest - 1):
+        raise ChangesExpired(since)
+      changes = QuestionChange.query.filter(QuestionChange.seq > since)\
+                .order_by(QuestionChange.seq).limit(limit).all()
+      return [change.format() for change in changes]
+    finally:
+      db.session.close()
+
+  def wait(self, since, limit, timeout):
+    """
+    This function returns the changes after `since` as soon as there are
+    any, or an empty list once `timeout` seconds have passed.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+      changes = self.read(since, limit)
+      remaining = deadline - time.monotonic()
+      if changes or remaining <= 0:
+        return changes
+      with self.condition:
+        self.condition.wait(min(self.poll_interval, remaining))
+
+  def stream(self, since, limit, duration, heartbeat):
+    """
+    This function yields the changes after `since` as Server-Sent Events
+    for `duration` seconds, with a comment every `heartbeat` seconds
+    without changes. An expired `since` yields one 'reset' event.
+    """
+    # EventSource reconnects after `retry` ms, sending the last event id
+    yield 'retry: 1000\n\n'
+    deadline = time.monotonic() + duration
+    while True:
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        return
+      try:
+        changes = self.wait(since, limit, min(heartbeat, remaining))
+      except ChangesExpired:
+        yield f'id: {self.latest()}\nevent: reset\ndata: {{}}\n\n'
+        return
+      if not changes:
+        yield ': keep-alive\n\n'
+      for change in changes:
+        yield f"id: {change['seq']}\nevent: {change['action']}\n" \
+              f"data: {json.dumps(change)}\n\n"
+        since = change['seq']
+
+
+def replica_reads():
+  """
+  This function returns a context manager for refilling a cache of
+  questions kept until the next data version bump: its reads stay on the
+  read replica once it caught up with the change log (see
+  ChangeFeed.replica_current) and go to the primary while it lags.
+  """
+  changes = current_app.extensions.get('trivia_changes') \
+            if has_request_context() else None
+  if changes is None or changes.replica_current():
+    return nullcontext()
+  return primary_reads()
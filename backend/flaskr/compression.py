@@ -0,0 +1,111 @@
+import gzip
+
+from flask import request
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+# encodings we can produce, preferred first when the client rates them equally
+ENCODINGS = ['br', 'gzip'] if brotli is not None else ['gzip']
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-ndjson'}
+
+
+def parse_accept_encoding(header):
+  """
+  This function returns the {coding: q} ratings of an Accept-Encoding header.
+  """
+  ratings = {}
+  for item in (header or '').split(','):
+    coding, _, params = item.strip().partition(';')
+    if not coding:
+      continue
+    quality = 1.0
+    params = params.strip()
+    if params.startswith('q='):
+      try:
+        quality = float(params[2:])
+      except ValueError:
+        quality = 0.0
+    ratings[coding.strip().lower()] = quality
+  return ratings
+
+
+def negotiate(header, encodings=ENCODINGS):
+  """
+  This function picks the encoding to send for an Accept-Encoding header,
+  or None for the identity encoding.
+  """
+  ratings = parse_accept_encoding(header)
+  wildcard = ratings.get('*', 0.0)
+  best, best_quality = None, 0.0
+  for encoding in encodings:
+    quality = ratings.get(encoding, wildcard)
+    if quality > best_quality:
+      best, best_quality = encoding, quality
+  return best
+
+
+def encoded_etag(etag, encoding):
+  """
+  This function returns the strong ETag of a body sent in `encoding`:
+  the compressed bytes differ from the identity body, so they get a
+  validator of their own.
+  """
+  return etag if encoding is None else f'{etag}-{encoding}'
+
+
+class Compressor:
+  """
+  Compresses JSON responses of at least COMPRESS_MIN_SIZE bytes with
+  brotli (when installed) or gzip, as negotiated with Accept-Encoding.
+  Streamed responses (bulk export) are sent as they are.
+  """
+
+  def __init__(self, app):
+    self.min_size = app.config['COMPRESS_MIN_SIZE']
+    self.level = app.config['COMPRESS_LEVEL']
+    self.brotli_quality = app.config['COMPRESS_BROTLI_QUALITY']
+    app.after_request(self.compress_response)
+
+  def compressible(self, response):
+    return self.min_size is not None and \
+           response.mimetype in COMPRESSIBLE_MIMETYPES
+
+  def encoding(self, body):
+    """
+    This function returns the encoding to send `body` in for the current
+    request, or None if it should go out uncompressed.
+    """
+    if self.min_size is None or len(body) < self.min_size:
+      return None
+    return negotiate(request.headers.get('Accept-Encoding'))
+
+  def compress(self, body, encoding):
+    if encoding == 'br':
+      return brotli.compress(body, quality=self.brotli_quality)
+    return gzip.compress(body, compresslevel=self.level)
+
+  def apply(self, response, body, encoding):
+    """
+    This function replaces the body of a response with its compressed form.
+    """
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag is not None and not etag.endswith(f'-{encoding}'):
+      response.set_etag(encoded_etag(etag, encoding), weak)
+
+  def compress_response(self, response):
+    if not self.compressible(response):
+      return response
+    response.vary.add('Accept-Encoding')
+    if response.direct_passthrough or response.is_streamed or \
+       response.status_code != 200 or 'Content-Encoding' in response.headers:
+      return response
+    body = response.get_data()
+    encoding = self.encoding(body)
+    if encoding is not None:
+      self.apply(response, self.compress(body, encoding), encoding)
+    return response
@@ -0,0 +1,125 @@
+import threading
+import time
+
+from flask import g, request, abort, has_request_context
+from sqlalchemy import event
+
+from models import db
+
+# PostgreSQL SQLSTATE of a statement cancelled by statement_timeout
+QUERY_CANCELED = '57014'
+# SQLite virtual machine steps between two deadline checks
+SQLITE_PROGRESS_STEPS = 1000
+# statement_timeout is lowered again once it exceeds the time left by this
+# many milliseconds, which bounds how far a statement overruns the deadline
+STATEMENT_TIMEOUT_SLACK = 50
+
+
+def is_timeout(error):
+  """
+  This function tells whether an OperationalError is a statement that
+  was cancelled for running past the request deadline.
+  """
+  original = getattr(error, 'orig', None)
+  return getattr(original, 'pgcode', None) == QUERY_CANCELED or \
+         str(original) == 'interrupted'
+
+
+class RequestLimits:
+  """
+  Per-route deadlines and concurrency limits, keyed by endpoint name.
+  A request gets ROUTE_DEADLINES[endpoint] (or DEFAULT_DEADLINE) seconds:
+  on PostgreSQL statement_timeout follows the time left before each
+  statement, on SQLite running statements are interrupted once it is up,
+  and no statement starts after it (504). At most ROUTE_CONCURRENCY
+  [endpoint] requests of a route run at once in a process, the ones
+  beyond are shed before they reach the database (503).
+  """
+
+  def __init__(self, app):
+    self.app = app
+    self.deadlines = app.config['ROUTE_DEADLINES']
+    self.default_deadline = app.config['DEFAULT_DEADLINE']
+    self.slots = {endpoint: threading.BoundedSemaphore(limit)
+                  for endpoint, limit in app.config['ROUTE_CONCURRENCY'].items()}
+    self.shed = self.timeouts = 0
+    self.instrumented = set()
+    app.before_request(self.before_request)
+    app.teardown_request(self.teardown_request)
+
+  def instrument(self):
+    # attach the listeners to engines not seen yet (engines change with URIs)
+    binds = [None] + list(self.app.config.get('SQLALCHEMY_BINDS') or ())
+    for engine in [db.get_engine(self.app, bind) for bind in binds]:
+      if engine in self.instrumented:
+        continue
+      if engine.dialect.name == 'postgresql':
+        event.listen(engine, 'begin', self.reset_statement_timeout)
+      event.listen(engine, 'before_cursor_execute', self.check_deadline)
+      self.instrumented.add(engine)
+
+  def remaining(self):
+    # seconds left before the deadline of the current request, or None
+    if not has_request_context() or g.get('deadline') is None:
+      return None
+    return g.deadline - time.monotonic()
+
+  def expired(self):
+    self.timeouts += 1
+    abort(504)
+
+  def reset_statement_timeout(self, connection):
+    # SET LOCAL ends with the transaction
+    connection.info['statement_timeout'] = None
+
+  def set_statement_timeout(self, conn, cursor, remaining):
+    # statement_timeout of the transaction, in ms, lowered as time passes
+    timeout = max(1, int(remaining * 1000))
+    current = conn.info.get('statement_timeout')
+    if current is None or current - timeout > STATEMENT_TIMEOUT_SLACK:
+      # on the cursor itself, so no events fire for it
+      cursor.execute(f'SET LOCAL statement_timeout = {timeout}')
+      conn.info['statement_timeout'] = timeout
+
+  def check_deadline(self, conn, cursor, statement, parameters, context,
+                     executemany):
+    remaining = self.remaining()
+    if remaining is not None and remaining <= 0:
+      self.expired()
+    if conn.dialect.name == 'postgresql':
+      if remaining is not None:
+        self.set_statement_timeout(conn, cursor, remaining)
+    elif conn.dialect.name == 'sqlite':
+      # set on every statement, so a pooled connection never keeps the
+      # deadline of an earlier request
+      deadline = None if remaining is None else g.deadline
+      conn.connection.connection.set_progress_handler(
+        None if deadline is None else lambda: time.monotonic() > deadline,
+        SQLITE_PROGRESS_STEPS)
+
+  def before_request(self):
+    self.instrument()
+    deadline = self.deadlines.get(request.endpoint, self.default_deadline)
+    g.deadline = None if deadline is None else time.monotonic() + deadline
+    slots = self.slots.get(request.endpoint)
+    if slots is not None:
+      if not slots.acquire(blocking=False):
+        self.shed += 1
+        abort(503)
+      g.request_slots = slots
+
+  def teardown_request(self, error):
+    slots = g.pop('request_slots', None)
+    if slots is not None:
+      slots.release()
+
+  def cancelled(self, error):
+    """
+    This function tells whether a database error is a statement cancelled
+    at the deadline, rolling the session back if so.
+    """
+    if not is_timeout(error):
+      return False
+    db.session.rollback()
+    self.timeouts += 1
+    return True
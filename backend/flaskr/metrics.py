@@ -0,0 +1,257 @@
+import threading
+import time
+import weakref
+from bisect import bisect_left
+
+from flask import g, request, has_request_context, Response
+from sqlalchemy import event
+
+from models import db
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+SIZE_BUCKETS = (128, 512, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+def _format_labels(names, values):
+  if not names:
+    return ''
+  pairs = ','.join(f'{name}="{value}"' for name, value in zip(names, values))
+  return '{' + pairs + '}'
+
+
+def _format_number(value):
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+  """
+  Monotonic counter per label set, rendered in Prometheus text format.
+  """
+  type = 'counter'
+
+  def __init__(self, name, help, labels=()):
+    self.name = name
+    self.help = help
+    self.labels = labels
+    self.values = {}
+
+  def inc(self, amount=1, *label_values):
+    self.values[label_values] = self.values.get(label_values, 0) + amount
+
+  def samples(self):
+    for label_values, value in sorted(self.values.items()):
+      yield self.name, _format_labels(self.labels, label_values), value
+
+
+class Gauge(Counter):
+  """
+  Value sampled from a callable when the metrics are rendered.
+  """
+  type = 'gauge'
+
+  def __init__(self, name, help, read):
+    super().__init__(name, help)
+    self.read = read
+
+  def samples(self):
+    value = self.read()
+    if value is not None:
+      yield self.name, '', value
+
+
+class SampledCounter(Gauge):
+  """
+  Counter kept elsewhere, sampled from a callable when rendered.
+  """
+  type = 'counter'
+
+
+class Histogram:
+  """
+  Cumulative histogram per label set, rendered in Prometheus text format.
+  """
+  type = 'histogram'
+
+  def __init__(self, name, help, buckets, labels=()):
+    self.name = name
+    self.help = help
+    self.buckets = buckets
+    self.labels = labels
+    self.series = {}
+
+  def observe(self, value, *label_values):
+    series = self.series.get(label_values)
+    if series is None:
+      # one slot per bucket plus +Inf, then sum and count
+      series = self.series[label_values] = [0] * (len(self.buckets) + 3)
+    series[bisect_left(self.buckets, value)] += 1
+    series[-2] += value
+    series[-1] += 1
+
+  def samples(self):
+    names = self.labels + ('le',)
+    for label_values, series in sorted(self.series.items()):
+      cumulative = 0
+      for bound, count in zip(self.buckets + ('+Inf',), series):
+        cumulative += count
+        yield (f'{self.name}_bucket',
+               _format_labels(names, label_values + (bound,)),
+               cumulative)
+      labels = _format_labels(self.labels, label_values)
+      yield f'{self.name}_sum', labels, series[-2]
+      yield f'{self.name}_count', labels, series[-1]
+
+
+class Metrics:
+  """
+  Collects per-request SQL counts and timings through SQLAlchemy engine
+  events, per-route latency and response sizes through Flask request hooks,
+  and connection pool checkout waits, and renders them for /metrics.
+  """
+
+  def __init__(self, app):
+    self.app = app
+    self.lock = threading.Lock()
+    self.slow_query_threshold = app.config['SLOW_QUERY_THRESHOLD']
+    self.request_duration = Histogram(
+      'trivia_request_duration_seconds', 'Request latency by route.',
+      LATENCY_BUCKETS, ('method', 'route', 'status'))
+    self.request_queries = Histogram(
+      'trivia_request_queries', 'SQL statements issued per request.',
+      QUERY_COUNT_BUCKETS, ('method', 'route'))
+    self.response_size = Histogram(
+      'trivia_response_size_bytes', 'Response body size by route.',
+      SIZE_BUCKETS, ('method', 'route'))
+    self.sql_duration = Counter(
+      'trivia_sql_duration_seconds_total', 'Time spent in SQL by route.',
+      ('method', 'route'))
+    self.slow_queries = Counter(
+      'trivia_slow_queries_total',
+      'SQL statements slower than SLOW_QUERY_THRESHOLD.')
+    self.checkout_wait = Histogram(
+      'trivia_pool_checkout_wait_seconds',
+      'Time spent waiting for a pooled connection.', LATENCY_BUCKETS)
+    self.metrics = [self.request_duration, self.request_queries,
+                    self.response_size, self.sql_duration, self.slow_queries,
+                    self.checkout_wait,
+                    Gauge('trivia_pool_checked_out',
+                          'Connections currently checked out.',
+                          lambda: self.pool_status('checkedout')),
+                    Gauge('trivia_pool_overflow',
+                          'Connections opened beyond the pool size.',
+                          lambda: self.pool_status('overflow'))]
+    self.instrumented = weakref.WeakSet()
+
+    with app.app_context():
+      self.instrument()
+    app.before_request(self.before_request)
+    app.after_request(self.after_request)
+
+  def gauge(self, name, help, read):
+    """
+    This function adds a gauge sampled from `read` when metrics are rendered.
+    """
+    with self.lock:
+      self.metrics.append(Gauge(name, help, read))
+
+  def counter(self, name, help, read):
+    """
+    This function adds a counter sampled from `read` when metrics are rendered.
+    """
+    with self.lock:
+      self.metrics.append(SampledCounter(name, help, read))
+
+  def engines(self):
+    binds = [None] + list(self.app.config.get('SQLALCHEMY_BINDS') or ())
+    return [db.get_engine(self.app, bind) for bind in binds]
+
+  def pool_status(self, name):
+    # only QueuePool reports checked out connections and overflow
+    with self.app.app_context():
+      status = getattr(db.get_engine(self.app).pool, name, None)
+    return status() if status is not None else None
+
+  def instrument(self):
+    """
+    This function attaches the SQL and pool listeners to every engine of
+    the app that does not have them yet (engines change when the URI does).
+    """
+    for engine in self.engines():
+      if engine in self.instrumented:
+        continue
+      event.listen(engine, 'before_cursor_execute',
+                   self.before_cursor_execute)
+      event.listen(engine, 'after_cursor_execute', self.after_cursor_execute)
+      self.instrument_pool(engine.pool)
+      self.instrumented.add(engine)
+
+  def instrument_pool(self, pool):
+    # pools have no "waiting" event, so time the internal checkout call
+    do_get = pool._do_get
+
+    def timed_do_get():
+      start = time.perf_counter()
+      try:
+        return do_get()
+      finally:
+        with self.lock:
+          self.checkout_wait.observe(time.perf_counter() - start)
+    pool._do_get = timed_do_get
+
+  def before_cursor_execute(self, conn, cursor, statement, parameters,
+                            context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+  def after_cursor_execute(self, conn, cursor, statement, parameters,
+                           context, executemany):
+    duration = time.perf_counter() - conn.info['query_start'].pop()
+    if has_request_context() and 'sql_count' in g:
+      g.sql_count += 1
+      g.sql_time += duration
+    if duration >= self.slow_query_threshold:
+      with self.lock:
+        self.slow_queries.inc()
+      self.app.logger.warning('slow query (%.1f ms): %s',
+                              duration * 1000, statement)
+
+  def before_request(self):
+    self.instrument()
+    g.request_start = time.perf_counter()
+    g.sql_count = 0
+    g.sql_time = 0.0
+
+  def after_request(self, response):
+    if 'request_start' not in g:
+      return response
+    duration = time.perf_counter() - g.request_start
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    method = request.method
+    size = response.calculate_content_length()
+    with self.lock:
+      self.request_duration.observe(duration, method, route,
+                                    response.status_code)
+      self.request_queries.observe(g.sql_count, method, route)
+      self.sql_duration.inc(g.sql_time, method, route)
+      if size is not None:
+        self.response_size.observe(size, method, route)
+    response.headers.add('Server-Timing',
+                         f'db;dur={g.sql_time * 1000:.2f};'
+                         f'desc="{g.sql_count} queries", '
+                         f'total;dur={duration * 1000:.2f}')
+    return response
+
+  def render(self):
+    """
+    This function returns all metrics in Prometheus text format.
+    """
+    lines = []
+    with self.lock:
+      for metric in self.metrics:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        for name, labels, value in metric.samples():
+          lines.append(f'{name}{labels} {_format_number(value)}')
+    return Response('\n'.join(lines) + '\n',
+                    mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,148 @@
+from flask import request, abort, current_app
+from sqlalchemy import func, and_, or_
+
+from models import db, data_versions
+from .changes import replica_reads
+
+# stands in for a NULL sort value in '<sort value>,<key>' cursors
+NULL_CURSOR = 'null'
+
+
+def get_page_size(args=None, settings=None):
+  """
+  This function returns the requested page size, capped by the app config.
+  `args` and `settings` default to those of the current Flask request.
+  """
+  args = request.args if args is None else args
+  settings = current_app.config if settings is None else settings
+  per_page = args.get('per_page', settings['QUESTIONS_PER_PAGE'], type=int)
+  if per_page < 1:
+    abort(400, 'Invalid per_page value!')
+  return min(per_page, settings['MAX_QUESTIONS_PER_PAGE'])
+
+
+def parse_cursor(after, sort_column):
+  """
+  This function parses an `after` cursor: a key for plain keyset pages,
+  '<sort value>,<key>' when the page is sorted on another column, with
+  NULL_CURSOR for a NULL sort value (parsed as None).
+  """
+  try:
+    if sort_column is None:
+      return (int(after),)
+    value, key = after.split(',')
+    return None if value == NULL_CURSOR else int(value), int(key)
+  except ValueError:
+    abort(400, 'Invalid after value!')
+
+
+def page_window(sort_column=None, args=None, settings=None):
+  """
+  This function reads the requested page: returns the page size, the
+  parsed `after` cursor (None without one) and the row offset.
+  """
+  args = request.args if args is None else args
+  per_page = get_page_size(args, settings)
+  after = args.get('after', None)
+  if after is not None:
+    return per_page, parse_cursor(after, sort_column), 0
+  page = args.get('page', 1, type=int)
+  if page < 1:
+    abort(404)
+  return per_page, None, (page - 1) * per_page
+
+
+def next_page_cursor(values):
+  """
+  This function formats the cursor of the page after a row whose
+  (sort value, key) or (key,) are `values`.
+  """
+  if len(values) == 1:
+    return values[0]
+  value, key = values
+  return '{},{}'.format(NULL_CURSOR if value is None else value, key)
+
+
+def page_query(query, key_column, sort_column=None, descending=False,
+               args=None, settings=None):
+  """
+  This function narrows `query` to one page of rows with LIMIT/OFFSET or,
+  when an `after` cursor is given, with a keyset filter on `key_column`
+  (preceded by `sort_column` if given, with `key_column` breaking ties).
+  NULL sort values come after all others, as in a PostgreSQL index:
+  last in ascending and first in descending order.
+  Returns the query, which fetches one row more than the page to tell
+  whether another page follows, and the page size.
+  """
+  per_page, values, offset = page_window(sort_column, args, settings)
+  if sort_column is None:
+    query = query.order_by(key_column.desc() if descending else key_column)
+  else:
+    query = query.order_by(sort_column.desc().nullsfirst() if descending
+                           else sort_column.asc().nullslast(),
+                           key_column.desc() if descending else key_column)
+  if values is not None:
+    beyond = (lambda column, value: column < value) if descending else \
+             (lambda column, value: column > value)
+    if sort_column is None:
+      query = query.filter(beyond(key_column, values[0]))
+    elif values[0] is None:
+      # after a NULL, the NULLs with a later key are left (and, in
+      # descending order, every non-NULL value)
+      nulls = and_(sort_column.is_(None), beyond(key_column, values[1]))
+      query = query.filter(or_(nulls, sort_column.isnot(None))
+                           if descending else nulls)
+    else:
+      # comparisons never match NULLs: ascending, they are still to come
+      later = or_(beyond(sort_column, values[0]),
+                  and_(sort_column == values[0],
+                       beyond(key_column, values[1])))
+      query = query.filter(later if descending
+                           else or_(later, sort_column.is_(None)))
+  else:
+    query = query.offset(offset)
+  return query.limit(per_page + 1), per_page
+
+
+def page_rows(rows, per_page, cursor_values):
+  """
+  This function cuts the rows fetched by a page_query down to the page.
+  Returns them and the cursor of the next page (None on the last page),
+  made of the `cursor_values(row)` of the last row.
+  """
+  if len(rows) <= per_page:
+    return rows, None
+  rows = rows[:per_page]
+  return rows, next_page_cursor(cursor_values(rows[-1]))
+
+
+def paginate(query, key_column, sort_column=None, descending=False):
+  """
+  This function fetches one page of rows, see page_query.
+  Returns the rows and the cursor of the next page (None on the last page).
+  """
+  columns = [key_column] if sort_column is None else [sort_column, key_column]
+  query, per_page = page_query(query, key_column, sort_column, descending)
+  return page_rows(query.all(), per_page,
+                   lambda row: [getattr(row, column.key) for column in columns])
+
+
+class CountCache:
+  """
+  Caches COUNT(*) results per key until the table's data version changes.
+  """
+
+  def __init__(self, table):
+    self.table = table
+    self.version = None
+    self.counts = {}
+
+  def get(self, column, *criteria, key=None):
+    if self.version != data_versions[self.table]:
+      self.counts = {}
+      self.version = data_versions[self.table]
+    if key not in self.counts:
+      with replica_reads():
+        self.counts[key] = db.session.query(func.count(column))\
+                           .filter(*criteria).scalar()
+    return self.counts[key]
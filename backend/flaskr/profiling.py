@@ -0,0 +1,233 @@
+import cProfile
+import os
+import random
+import re
+import secrets
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import g, request, current_app
+from itsdangerous import TimestampSigner, BadSignature
+
+# requests carrying a valid token (see RequestProfiler.token) are profiled
+PROFILE_HEADER = 'X-Profile-Token'
+PROFILE_SALT = 'trivia-profile'
+PROFILE_VALUE = b'profile'
+PROFILE_FORMATS = ('collapsed', 'pstats')
+# <id>.<endpoint>.<duration>ms.<format>, ids sort by creation time
+PROFILE_NAME = re.compile(r'^(\d{13}-[0-9a-f]{8})\.(\w+)\.(\d+)ms\.'
+                          r'(collapsed|pstats)$')
+
+
+def collapse(frame, labels):
+  """
+  This function renders the stack ending in `frame` as one collapsed
+  stack line ('file:function;...' from the outermost frame), the input
+  format of flamegraph.pl. `labels` caches the label of each code object.
+  """
+  names = []
+  while frame is not None:
+    code = frame.f_code
+    label = labels.get(code)
+    if label is None:
+      label = labels[code] = \
+        f'{os.path.basename(code.co_filename)}:{code.co_name}'
+    names.append(label)
+    frame = frame.f_back
+  return ';'.join(reversed(names))
+
+
+class StackSampler:
+  """
+  Samples the stack of the thread that created it every `interval`
+  seconds from a background thread. The profiled thread runs untouched
+  between samples, so the overhead stays low and independent of the
+  number of calls. While the thread holds the GIL, samples come at most
+  every sys.getswitchinterval() seconds (5 ms by default).
+  """
+
+  def __init__(self, interval):
+    self.interval = interval
+    self.thread_id = threading.get_ident()
+    self.stacks = Counter()
+    self.labels = {}
+    self.stopped = threading.Event()
+    self.thread = threading.Thread(target=self.run, daemon=True)
+
+  def start(self):
+    self.thread.start()
+
+  def run(self):
+    while not self.stopped.wait(self.interval):
+      frame = sys._current_frames().get(self.thread_id)
+      if frame is not None:
+        self.stacks[collapse(frame, self.labels)] += 1
+
+  def stop(self):
+    self.stopped.set()
+    self.thread.join()
+
+  def dump(self, path):
+    with open(path, 'w') as output:
+      for stack, count in self.stacks.most_common():
+        output.write(f'{stack} {count}\n')
+
+
+class TracingProfiler:
+  """
+  cProfile of the current thread, written as pstats: exact call counts
+  and times, at the cost of a hook on every call.
+  """
+
+  def __init__(self):
+    self.profile = cProfile.Profile()
+
+  def start(self):
+    self.profile.enable()
+
+  def stop(self):
+    self.profile.disable()
+
+  def dump(self, path):
+    self.profile.dump_stats(path)
+
+
+class RequestProfiler:
+  """
+  Profiles the requests carrying a signed PROFILE_HEADER token, and a
+  random PROFILE_SAMPLE_RATE share of the others, of PROFILE_ENDPOINTS
+  (all endpoints for None). Each profile is written to PROFILE_DIR, which
+  keeps the last PROFILE_MAX_FILES of them, and its id is returned in
+  the X-Profile-Id response header.
+  """
+
+  def __init__(self, app):
+    self.format = app.config['PROFILE_FORMAT']
+    if self.format not in PROFILE_FORMATS:
+      raise ValueError(f'PROFILE_FORMAT {self.format!r} is not one of '
+                       f'{PROFILE_FORMATS}')
+    self.directory = os.path.abspath(
+      app.config['PROFILE_DIR'] or os.path.join(app.instance_path,
+                                                'profiles'))
+    self.interval = app.config['PROFILE_INTERVAL']
+    self.sample_rate = app.config['PROFILE_SAMPLE_RATE']
+    self.endpoints = app.config['PROFILE_ENDPOINTS']
+    self.max_files = app.config['PROFILE_MAX_FILES']
+    self.token_max_age = app.config['PROFILE_TOKEN_MAX_AGE']
+    self.signer = TimestampSigner(app.config['SECRET_KEY'], salt=PROFILE_SALT)
+    app.before_request(self.before_request)
+    app.after_request(self.after_request)
+    app.teardown_request(self.teardown_request)
+
+  def token(self):
+    """
+    This function returns a token that profiles the requests sending it
+    in PROFILE_HEADER, and opens the profile endpoints, for
+    PROFILE_TOKEN_MAX_AGE seconds.
+    """
+    return self.signer.sign(PROFILE_VALUE).decode()
+
+  def authorized(self):
+    """
+    This function tells whether the request carries a valid token.
+    """
+    token = request.headers.get(PROFILE_HEADER)
+    if token is None:
+      return False
+    try:
+      return self.signer.unsign(token, max_age=self.token_max_age) == \
+             PROFILE_VALUE
+    except BadSignature:
+      return False
+
+  def before_request(self):
+    # the profile endpoints are never profiled themselves
+    if request.endpoint is None or request.path.startswith('/admin/') or \
+       (self.endpoints is not None and request.endpoint not in self.endpoints):
+      return
+    if not self.authorized() and random.random() >= self.sample_rate:
+      return
+    profiler = StackSampler(self.interval) if self.format == 'collapsed' \
+               else TracingProfiler()
+    try:
+      profiler.start()
+    except ValueError:
+      # cProfile is already profiling another request of this process
+      return
+    profile_id = f'{time.time_ns() // 1000000:013d}-{secrets.token_hex(4)}'
+    g.profile = (profile_id, profiler, time.perf_counter())
+
+  def after_request(self, response):
+    if 'profile' in g:
+      response.headers['X-Profile-Id'] = g.profile[0]
+    return response
+
+  def teardown_request(self, error):
+    profile = g.pop('profile', None)
+    if profile is None:
+      return
+    profile_id, profiler, started = profile
+    profiler.stop()
+    duration = round((time.perf_counter() - started) * 1000)
+    name = f'{profile_id}.{request.endpoint}.{duration}ms.{self.format}'
+    try:
+      self.save(profiler, name)
+    except OSError as error:
+      current_app.logger.warning('profile %s not saved: %s', name, error)
+
+  def save(self, profiler, name):
+    """
+    This function writes a profile to the directory, then drops the oldest
+    profiles beyond PROFILE_MAX_FILES.
+    """
+    os.makedirs(self.directory, exist_ok=True)
+    path = os.path.join(self.directory, name)
+    # readers never see a partial profile
+    profiler.dump(path + '.tmp')
+    os.replace(path + '.tmp', path)
+    for profile in self.profiles()[self.max_files:]:
+      try:
+        os.remove(os.path.join(self.directory, profile['name']))
+      except FileNotFoundError:
+        pass
+
+  def profiles(self):
+    """
+    This function returns the stored profiles as dicts, newest first.
+    """
+    try:
+      names = os.listdir(self.directory)
+    except FileNotFoundError:
+      return []
+    profiles = []
+    for name in sorted(names, reverse=True):
+      match = PROFILE_NAME.match(name)
+      if match is None:
+        continue
+      profile_id, endpoint, duration, format = match.groups()
+      try:
+        size = os.path.getsize(os.path.join(self.directory, name))
+      except FileNotFoundError:
+        # removed by another worker since the listing
+        continue
+      profiles.append({
+        'id': profile_id,
+        'name': name,
+        'endpoint': endpoint,
+        'duration_ms': int(duration),
+        'format': format,
+        'created': int(profile_id[:13]) / 1000,
+        'size': size
+      })
+    return profiles
+
+  def find(self, profile_id):
+    """
+    This function returns the file name of a stored profile, or None.
+    """
+    for profile in self.profiles():
+      if profile['id'] == profile_id:
+        return profile['name']
+    return None
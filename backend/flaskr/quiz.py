@@ -0,0 +1,252 @@
+import base64
+import hashlib
+import random
+import threading
+import zlib
+
+from itsdangerous import Signer, BadSignature
+
+from models import db, Question, data_versions
+from .changes import replica_reads
+
+# random draws to try before falling back to scanning the unseen ids
+MAX_REJECTIONS = 16
+# upper bound on a decoded seen token, guards against zip bombs
+MAX_SEEN_TOKEN_BYTES = 1 << 20
+
+
+class IdList:
+  """
+  A list of distinct ids to draw from with random.choice, which also
+  knows the position of each id, so removing one moves the last id into
+  its place instead of shifting the whole list.
+  """
+
+  def __init__(self, ids=()):
+    self.ids = list(ids)
+    self.positions = {question_id: position
+                      for position, question_id in enumerate(self.ids)}
+
+  def __len__(self):
+    return len(self.ids)
+
+  def __getitem__(self, position):
+    return self.ids[position]
+
+  def __iter__(self):
+    return iter(self.ids)
+
+  def add(self, question_id):
+    if question_id not in self.positions:
+      self.positions[question_id] = len(self.ids)
+      self.ids.append(question_id)
+
+  def discard(self, question_id):
+    position = self.positions.pop(question_id, None)
+    if position is None:
+      return
+    last = self.ids.pop()
+    if position < len(self.ids):
+      self.ids[position] = last
+      self.positions[last] = position
+
+
+class QuestionPool:
+  """
+  Keeps the ids of all questions in memory, grouped by category, so a quiz
+  step can draw a random unseen id without ORDER BY random().
+  Loaded on first use, then kept current by question inserts, updates and
+  deletes (see models.question_listeners); a reset or any other write
+  reloads it.
+  """
+
+  def __init__(self):
+    self.version = None
+    self.all_ids = IdList()
+    self.ids_by_category = {}
+    self.categories = {}
+    self.lock = threading.Lock()
+
+  def invalidate(self):
+    self.version = None
+
+  def refresh(self):
+    if self.version == data_versions['questions']:
+      return
+    version = data_versions['questions']
+    with replica_reads():
+      self.load(db.session.query(Question.id, Question.category)
+                .yield_per(1000), version)
+
+  def load(self, rows, version):
+    """
+    This function rebuilds the pool from (id, category) rows loaded
+    at the given data version.
+    """
+    categories = {}
+    ids_by_category = {}
+    for question_id, category in rows:
+      categories[question_id] = category
+      ids_by_category.setdefault(category, []).append(question_id)
+    ids_by_category = {category: IdList(ids)
+                       for category, ids in ids_by_category.items()}
+    with self.lock:
+      self.all_ids = IdList(categories)
+      self.ids_by_category = ids_by_category
+      self.categories = categories
+      self.version = version
+
+  def questions_changed(self, changes):
+    """
+    This function applies the committed changes of one write,
+    provided the pool was current just before it; otherwise, or after a
+    reset, the next refresh reloads it.
+    """
+    with self.lock:
+      version = data_versions['questions']
+      if self.version != version - 1:
+        return
+      for action, question in changes:
+        if action in ('insert', 'update'):
+          # add drops the old entry, so an update moves the question
+          self.add(question['id'], question['category'])
+        elif action == 'delete':
+          self.remove(question['id'])
+        else:
+          self.version = None
+          return
+      self.version = version
+
+  def add(self, question_id, category):
+    self.remove(question_id)
+    self.categories[question_id] = category
+    self.all_ids.add(question_id)
+    self.ids_by_category.setdefault(category, IdList()).add(question_id)
+
+  def remove(self, question_id):
+    if question_id not in self.categories:
+      return
+    category = self.categories.pop(question_id)
+    self.all_ids.discard(question_id)
+    self.ids_by_category[category].discard(question_id)
+
+  def draw(self, category, seen):
+    """
+    This function returns a random question id of the given category
+    (None for all categories) that is not in `seen`, or None if the
+    category has no unseen questions left.
+    """
+    self.refresh()
+    # a concurrent delete must not shrink the list under random.choice
+    with self.lock:
+      if category is None:
+        return draw_unseen(self.all_ids, seen)
+      return draw_unseen(self.ids_by_category.get(category, ()), seen)
+
+
+def draw_unseen(ids, seen):
+  """
+  This function returns a random id of the sequence `ids` that is not in
+  `seen`, or None if every id has been seen.
+  """
+  if not len(ids):
+    return None
+  # rejection sampling: cheap while most of the pool is still unseen
+  for _ in range(MAX_REJECTIONS):
+    question_id = random.choice(ids)
+    if question_id not in seen:
+      return question_id
+  # the quiz has used up most of the pool, pick among what is left
+  remaining = [question_id for question_id in ids if question_id not in seen]
+  return random.choice(remaining) if remaining else None
+
+
+def parse_quiz_request(data, secret):
+  """
+  This function checks the body of POST /quizzes. Returns the quiz
+  category id (None for all categories) and the set of seen question ids,
+  or raises ValueError with the message sent back to the client.
+  """
+  if data is None:
+    raise ValueError('No data provided!')
+  elif not isinstance(data, dict):
+    raise ValueError(f'{data!r}, the quiz request is not a JSON object!')
+  # previous questions can be sent as a list and/or as a seen_token
+  if ('previous_questions' not in data.keys() and
+      'seen_token' not in data.keys()) or \
+     'quiz_category' not in data.keys():
+    raise ValueError(f'{data},\'previous_questions\' and/or \'quiz_category\' are missing!')
+
+  previous_questions = data.get('previous_questions', [])
+  quiz_category = data['quiz_category']
+  # check all values are valid
+  if quiz_category is None or not isinstance(quiz_category, dict):
+    raise ValueError(f'{data},\'quiz_category\' is None or not a dictionary!')
+  elif not isinstance(previous_questions, list):
+    raise ValueError(f'{previous_questions}, \'previous_questions\' is not a list!')
+  elif 'id' not in quiz_category.keys():
+    raise ValueError(f'{quiz_category}, \'id\' key is missing!')
+  elif type(quiz_category['id']) is not int:
+    raise ValueError(f'{quiz_category}, \'id\' is not an integer!')
+  elif not isinstance(data.get('seen_token', ''), str):
+    raise ValueError(f'{data["seen_token"]}, \'seen_token\' is not a string!')
+  seen = set(question_id for question_id in previous_questions
+             if isinstance(question_id, int) and question_id > 0)
+  if 'seen_token' in data:
+    try:
+      seen |= load_seen_token(data['seen_token'], secret)
+    except ValueError:
+      raise ValueError('Invalid seen_token!')
+  category = quiz_category['id'] if quiz_category['id'] != 0 else None
+  return category, seen
+
+
+def _signer(secret):
+  return Signer(secret, salt='quiz-seen', digest_method=hashlib.sha256)
+
+
+def dump_seen_token(ids, secret):
+  """
+  This function encodes a set of question ids as a compact signed token:
+  sorted ids are delta encoded as varints, deflated, base64 encoded and
+  signed so clients can echo it back instead of the full id list.
+  """
+  encoded = bytearray()
+  previous = 0
+  for question_id in sorted(ids):
+    delta = question_id - previous
+    previous = question_id
+    while delta >= 0x80:
+      encoded.append((delta & 0x7f) | 0x80)
+      delta >>= 7
+    encoded.append(delta)
+  payload = base64.urlsafe_b64encode(zlib.compress(bytes(encoded), 9))
+  return _signer(secret).sign(payload.rstrip(b'=')).decode('ascii')
+
+
+def load_seen_token(token, secret):
+  """
+  This function verifies a token made by `dump_seen_token` and returns
+  its question ids as a set. Raises ValueError if it is invalid.
+  """
+  try:
+    payload = _signer(secret).unsign(token.encode('ascii'))
+    payload += b'=' * (-len(payload) % 4)
+    decompressor = zlib.decompressobj()
+    encoded = decompressor.decompress(base64.urlsafe_b64decode(payload),
+                                      MAX_SEEN_TOKEN_BYTES)
+  except (BadSignature, UnicodeError, ValueError, zlib.error):
+    raise ValueError('invalid seen token')
+  if decompressor.unconsumed_tail:
+    raise ValueError('seen token is too large')
+  ids = set()
+  current = delta = shift = 0
+  for byte in encoded:
+    delta |= (byte & 0x7f) << shift
+    if byte & 0x80:
+      shift += 7
+    else:
+      current += delta
+      ids.add(current)
+      delta = shift = 0
+  return ids
@@ -0,0 +1,92 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import nullcontext
+from functools import wraps
+
+from flask import request, Response
+
+from models import data_versions
+from .changes import replica_reads
+from .compression import encoded_etag
+
+
+class ResponseCache:
+  """
+  LRU cache of rendered JSON bodies for read endpoints, keyed by path and
+  query args. Entries remember the data versions they were rendered at and
+  are dropped once any table is written to. Responses carry a strong ETag
+  so clients can revalidate with If-None-Match and get a 304.
+  With a compressor, compressed bodies are cached alongside per encoding.
+  With a `generation` function, e.g. of a shared snapshot, entries are
+  also dropped once writes in other worker processes move it on.
+  """
+
+  def __init__(self, max_entries, compressor=None, generation=None):
+    self.max_entries = max_entries
+    self.compressor = compressor
+    self.generation = generation
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+
+  def lookup(self, key, version):
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None:
+        return None
+      if entry[0] != version:
+        del self.entries[key]
+        return None
+      self.entries.move_to_end(key)
+      return entry
+
+  def store(self, key, version, body, etag, variants):
+    with self.lock:
+      self.entries[key] = (version, body, etag, variants)
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+
+  def cached(self, view):
+    """
+    This decorator serves a view from the cache. Only 200 responses are
+    stored; aborted requests go through the normal error handlers.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+      key = (request.path, tuple(sorted(request.args.items(multi=True))))
+      version = tuple(sorted(data_versions.items()))
+      if self.generation is not None:
+        version += (self.generation(),)
+      entry = self.lookup(key, version)
+      if entry is None:
+        # the body is kept until the next write, so never render it from
+        # a replica that lags behind that write
+        with replica_reads() if self.max_entries > 0 else nullcontext():
+          response = view(*args, **kwargs)
+        if response.status_code != 200:
+          return response
+        body = response.get_data()
+        etag = hashlib.sha1(body).hexdigest()
+        variants = {}
+        self.store(key, version, body, etag, variants)
+      else:
+        _, body, etag, variants = entry
+      encoding = None
+      if self.compressor is not None:
+        encoding = self.compressor.encoding(body)
+      response = Response(body, mimetype='application/json')
+      # revalidated against the ETag of the encoding the client gets
+      response.set_etag(encoded_etag(etag, encoding))
+      response.headers['Cache-Control'] = 'no-cache'
+      response = response.make_conditional(request)
+      if encoding is not None and response.status_code == 200:
+        if encoding not in variants:
+          variants[encoding] = self.compressor.compress(body, encoding)
+        self.compressor.apply(response, variants[encoding], encoding)
+      return response
+    return wrapper
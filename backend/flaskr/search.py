@@ -0,0 +1,270 @@
+import math
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+
+from sqlalchemy import text
+
+from models import db, Question, data_versions, SEARCH_DOCUMENT
+from .changes import replica_reads
+from .serialization import QUESTION_COLUMNS, with_columns
+
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+# matches in the question text count more than matches in the answer
+QUESTION_WEIGHT = 2.0
+ANSWER_WEIGHT = 1.0
+
+
+def tokenize(value):
+  """
+  This function splits text into lowercase word tokens.
+  """
+  return TOKEN_PATTERN.findall((value or '').lower())
+
+
+def parse_search_term(data):
+  """
+  This function checks the body of POST /questions/search and returns the
+  search term, or raises ValueError with the message sent to the client.
+  """
+  if not isinstance(data, dict) or 'searchTerm' not in data:
+    raise ValueError('\'searchTerm\' is missing!')
+  if not isinstance(data['searchTerm'], str):
+    raise ValueError(f"{data['searchTerm']!r}, 'searchTerm' is not a string!")
+  return data['searchTerm']
+
+
+def load_questions(ids, columns=QUESTION_COLUMNS):
+  """
+  This function fetches question rows of `columns` (followed by the id
+  if it is not among them) by primary key, keeping the order of `ids`.
+  """
+  if not ids:
+    return []
+  questions = {question.id: question
+               for question in db.session.query(*with_columns(columns,
+                                                              Question.id))
+                                         .filter(Question.id.in_(ids))}
+  return [questions[question_id] for question_id in ids
+          if question_id in questions]
+
+
+class InvertedIndexBackend:
+  """
+  In-process inverted index over question and answer text.
+  Used for SQLite and tests; rebuilt when the questions data version changes.
+  Every search token is matched as a prefix, so 'pen' finds 'penicillin'.
+  """
+  name = 'memory'
+
+  def __init__(self):
+    self.version = None
+    self.postings = {}
+    self.vocabulary = []
+    self.categories = {}
+
+  def refresh(self):
+    if self.version == data_versions['questions']:
+      return
+    version = data_versions['questions']
+    with replica_reads():
+      self.load(db.session.query(Question.id, Question.question,
+                                 Question.answer, Question.category)
+                .yield_per(1000), version)
+
+  def load(self, rows, version):
+    """
+    This function rebuilds the index from (id, question, answer, category)
+    rows loaded at the given data version.
+    """
+    postings = {}
+    categories = {}
+    for question_id, question, answer, category in rows:
+      categories[question_id] = category
+      for tokens, weight in ((tokenize(question), QUESTION_WEIGHT),
+                             (tokenize(answer), ANSWER_WEIGHT)):
+        for token in tokens:
+          documents = postings.setdefault(token, {})
+          documents[question_id] = documents.get(question_id, 0) + weight
+    # swap the whole index so concurrent readers never see a partial build
+    self.postings = postings
+    self.vocabulary = sorted(postings)
+    self.categories = categories
+    self.version = version
+
+  def expand(self, prefix):
+    """
+    This function yields every indexed token starting with `prefix`.
+    """
+    vocabulary = self.vocabulary
+    position = bisect_left(vocabulary, prefix)
+    while position < len(vocabulary) and vocabulary[position].startswith(prefix):
+      yield vocabulary[position]
+      position += 1
+
+  def search(self, term, category, limit, offset):
+    tokens = tokenize(term)
+    # a term without any word (blank or punctuation only) matches nothing
+    if not tokens:
+      return [], 0
+    self.refresh()
+    total_documents = len(self.categories)
+    scores = None
+    for prefix in tokens:
+      matched = {}
+      for token in self.expand(prefix):
+        documents = self.postings[token]
+        idf = math.log(1 + total_documents / len(documents))
+        for question_id, weight in documents.items():
+          matched[question_id] = max(matched.get(question_id, 0),
+                                     weight * idf)
+      # every search token has to match (AND semantics)
+      if scores is None:
+        scores = matched
+      else:
+        scores = {question_id: score + matched[question_id]
+                  for question_id, score in scores.items()
+                  if question_id in matched}
+      if not scores:
+        break
+    if category is not None:
+      scores = {question_id: score for question_id, score in scores.items()
+                if self.categories[question_id] == category}
+    ranked = sorted(scores, key=lambda question_id: (-scores[question_id],
+                                                     question_id))
+    return ranked[offset:offset + limit], len(ranked)
+
+
+class PostgresBackend:
+  """
+  Full-text search with a GIN-indexed tsvector over question and answer,
+  ranked with ts_rank_cd. The query repeats the indexed expression verbatim
+  so the planner can use the index, which `flask migrate` builds.
+  """
+  name = 'postgres'
+  document = SEARCH_DOCUMENT
+
+  def statements(self, term, category, limit, offset):
+    """
+    This function builds the count and the ranked id page statements
+    of a search, with their parameters. `term` has to hold at least one
+    token.
+    """
+    tokens = tokenize(term)
+    # every token becomes a prefix match, all of them required
+    params = {'limit': limit, 'offset': offset,
+              'query': ' & '.join(f'{token}:*' for token in tokens)}
+    conditions = [f"({self.document}) @@ to_tsquery('simple', :query)"]
+    order = (f"ts_rank_cd(({self.document}), to_tsquery('simple', :query)) "
+             'DESC, id')
+    if category is not None:
+      params['category'] = category
+      conditions.append('category = :category')
+    where = f"WHERE {' AND '.join(conditions)}"
+    count = f'SELECT count(*) FROM questions {where}'
+    page = (f'SELECT id FROM questions {where} '
+            f'ORDER BY {order} LIMIT :limit OFFSET :offset')
+    return count, page, params
+
+  def search(self, term, category, limit, offset):
+    # a term without any word (blank or punctuation only) matches nothing
+    if not tokenize(term):
+      return [], 0
+    count, page, params = self.statements(term, category, limit, offset)
+    total = db.session.execute(text(count), params).scalar()
+    rows = db.session.execute(text(page), params)
+    return [row[0] for row in rows], total
+
+
+class SearchCache:
+  """
+  LRU cache of search results in front of a search backend, keyed by the
+  normalized term (its tokens, which is all the backends look at) and the
+  category. Entries hold the first `max_results` ranked ids and the total
+  count; pages beyond them go to the backend. Entries are dropped once the
+  questions data version (or the `generation`, e.g. of a shared snapshot)
+  moves on, and expire after `ttl` seconds so that writes of other worker
+  processes show up.
+  """
+
+  def __init__(self, backend, max_entries, ttl, max_results, generation=None):
+    self.backend = backend
+    self.max_entries = max_entries
+    self.ttl = ttl
+    self.max_results = max_results
+    self.generation = generation
+    self.version = None
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = self.misses = self.evictions = 0
+
+  def current_version(self):
+    version = data_versions['questions']
+    if self.generation is not None:
+      return version, self.generation()
+    return version
+
+  def lookup(self, key, version):
+    with self.lock:
+      if self.version != version:
+        self.entries.clear()
+        self.version = version
+      entry = self.entries.get(key)
+      if entry is not None and entry[0] <= time.monotonic():
+        del self.entries[key]
+        entry = None
+      if entry is None:
+        self.misses += 1
+        return None
+      self.entries.move_to_end(key)
+      self.hits += 1
+      return entry
+
+  def store(self, key, version, ids, total):
+    with self.lock:
+      if self.version != version:
+        return
+      self.entries[key] = (time.monotonic() + self.ttl, ids, total)
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+        self.evictions += 1
+
+  def search(self, term, category, limit, offset):
+    """
+    This function returns a page of ranked question ids and the total
+    number of matches, like the backend's search.
+    """
+    if self.max_entries < 1 or offset + limit > self.max_results:
+      return self.backend.search(term, category, limit, offset)
+    key = (' '.join(tokenize(term)), category)
+    version = self.current_version()
+    entry = self.lookup(key, version)
+    if entry is None:
+      # kept until the TTL, so not read from a lagging replica
+      with replica_reads():
+        ids, total = self.backend.search(term, category, self.max_results, 0)
+      self.store(key, version, ids, total)
+    else:
+      _, ids, total = entry
+    return ids[offset:offset + limit], total
+
+  def __len__(self):
+    return len(self.entries)
+
+
+def create_search_backend(app):
+  """
+  This function picks the search backend for the app, following the
+  SEARCH_BACKEND config ('auto', 'postgres' or 'memory').
+  """
+  backend = app.config['SEARCH_BACKEND']
+  if backend == 'auto':
+    with app.app_context():
+      dialect = db.get_engine(app).dialect.name
+    backend = 'postgres' if dialect == 'postgresql' else 'memory'
+  if backend == 'postgres':
+    return PostgresBackend()
+  return InvertedIndexBackend()
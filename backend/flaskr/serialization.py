@@ -0,0 +1,155 @@
+import json
+from json.encoder import encode_basestring_ascii
+
+from flask import current_app, request, abort
+from sqlalchemy import Integer
+
+from models import Question
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+# the columns of Question.format(), selected as plain rows
+QUESTION_COLUMNS = (Question.id, Question.question, Question.answer,
+                    Question.category, Question.difficulty)
+QUESTION_FIELDS = tuple(column.key for column in QUESTION_COLUMNS)
+
+
+def parse_fields(fields):
+  """
+  This function returns the QUESTION_COLUMNS named in a comma separated
+  `fields` value, in QUESTION_COLUMNS order, or all of them for None.
+  Raises ValueError on an unknown or empty name.
+  """
+  if fields is None:
+    return QUESTION_COLUMNS
+  names = {name.strip() for name in fields.split(',')}
+  if not names <= set(QUESTION_FIELDS):
+    raise ValueError('Invalid fields value!')
+  return tuple(column for column in QUESTION_COLUMNS if column.key in names)
+
+
+def get_fields():
+  """
+  This function returns the question columns requested with ?fields=.
+  """
+  try:
+    return parse_fields(request.args.get('fields', None))
+  except ValueError as error:
+    abort(400, str(error))
+
+
+def with_columns(columns, *required):
+  """
+  This function returns `columns` followed by the ones of `required`
+  (e.g. the keys a page cursor is read from) they do not include yet.
+  Rows selected this way encode with `columns` alone, see `encode_rows`.
+  """
+  keys = {column.key for column in columns}
+  return tuple(columns) + tuple(column for column in required
+                                if column is not None
+                                and column.key not in keys)
+
+
+def project_rows(rows, columns):
+  """
+  This function narrows rows in QUESTION_COLUMNS order to `columns`.
+  """
+  if len(columns) == len(QUESTION_COLUMNS):
+    return rows
+  indexes = [QUESTION_FIELDS.index(column.key) for column in columns]
+  return [tuple(row[index] for index in indexes) for row in rows]
+
+
+def stdlib_dumps(data):
+  # same output as Flask 1.0's jsonify: sorted keys, compact, ASCII only
+  return json.dumps(data, sort_keys=True, separators=(',', ':'))\
+         .encode('ascii')
+
+
+def orjson_dumps(data):
+  # orjson only sorts str keys together with OPT_NON_STR_KEYS
+  return orjson.dumps(data, option=orjson.OPT_SORT_KEYS |
+                                   orjson.OPT_NON_STR_KEYS)
+
+
+ENCODERS = {'json': stdlib_dumps}
+if orjson is not None:
+  ENCODERS['orjson'] = orjson_dumps
+
+
+def get_encoder(name):
+  """
+  This function returns the dumps function of a JSON_BACKEND value:
+  'orjson', 'json', or 'auto' for orjson when it is installed.
+  """
+  if name == 'auto':
+    name = 'orjson' if orjson is not None else 'json'
+  if name not in ENCODERS:
+    raise ValueError(f'JSON backend {name!r} is not available')
+  return ENCODERS[name]
+
+
+class RawJSON(bytes):
+  """
+  Already encoded JSON, spliced verbatim into the output of `dumps`.
+  """
+
+
+def dumps(data, encoder):
+  """
+  This function encodes `data` to JSON bytes. Values of a top-level dict
+  may be RawJSON, e.g. rows encoded by `encode_rows`.
+  """
+  if not isinstance(data, dict) or \
+     not any(isinstance(value, RawJSON) for value in data.values()):
+    return encoder(data)
+  return b'{' + b','.join(
+    encoder(key) + b':' + (value if isinstance(value, RawJSON)
+                           else encoder(value))
+    for key, value in sorted(data.items())) + b'}'
+
+
+def encode_rows(rows, columns):
+  """
+  This function encodes rows of a column-only select straight into a
+  JSON array of objects keyed by column name, without building a dict
+  per row: strings are escaped column by column, then every row is
+  rendered with one %-format of a template built for these columns.
+  Values of rows beyond `columns` are left out.
+  """
+  names = [column.key for column in columns]
+  order = sorted(range(len(names)), key=names.__getitem__)
+  values = list(zip(*rows))
+  if not values:
+    return RawJSON(b'[]')
+  fields = []
+  for index in order:
+    column = values[index]
+    nullable = None in column
+    if isinstance(columns[index].type, Integer) and not nullable:
+      fields.append(('%d', column))
+    elif isinstance(columns[index].type, Integer):
+      fields.append(('%s', ['null' if value is None else str(value)
+                            for value in column]))
+    elif not nullable:
+      fields.append(('%s', map(encode_basestring_ascii, column)))
+    else:
+      fields.append(('%s', ['null' if value is None
+                            else encode_basestring_ascii(value)
+                            for value in column]))
+  template = '{' + ','.join(f'{encode_basestring_ascii(names[index])}:{format}'
+                            for index, (format, _) in zip(order, fields)) + '}'
+  rendered = [template % row for row in zip(*[column for _, column in fields])]
+  return RawJSON(('[' + ','.join(rendered) + ']').encode('ascii'))
+
+
+def jsonify(data):
+  """
+  This function replaces flask.jsonify with the app's JSON_BACKEND.
+  """
+  encoder = get_encoder(current_app.config['JSON_BACKEND'])
+  return current_app.response_class(dumps(data, encoder) + b'\n',
+                                    mimetype='application/json')
@@ -0,0 +1,363 @@
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+from models import db, Question, Category
+from .quiz import draw_unseen
+from .serialization import QUESTION_COLUMNS
+
+MAGIC = b'TRIVIA01'
+# magic, generation, question count, category count
+HEADER = struct.Struct('<8sQQQ')
+# every section is an int64 array, except the two UTF-8 string heaps:
+#   ids, categories, difficulties   one entry per question, sorted by id
+#   text_offsets, text_heap         question i is text_heap[offsets[2i]:
+#                                   offsets[2i+1]], its answer follows it
+#   by_category, by_difficulty      question positions sorted by (category,
+#                                   id) and by (category, difficulty, id)
+#   directory, directory_starts     the distinct categories and where their
+#                                   runs start in both orderings
+#   category_ids, type_offsets, type_heap   the categories table
+SECTIONS = ('ids', 'categories', 'difficulties', 'text_offsets', 'text_heap',
+            'by_category', 'by_difficulty', 'directory', 'directory_starts',
+            'category_ids', 'type_offsets', 'type_heap')
+TABLE = struct.Struct('<' + 'QQ' * len(SECTIONS))
+# stands in for NULL category and difficulty values
+NULL = -1
+
+
+def build_snapshot(path, generation):
+  """
+  This function writes the questions and categories tables of the current
+  app's database to a snapshot file, replacing `path` atomically.
+  """
+  ids, categories, difficulties = array('q'), array('q'), array('q')
+  text_offsets, text_heap = array('q', [0]), bytearray()
+  rows = db.session.query(*QUESTION_COLUMNS).order_by(Question.id)\
+         .yield_per(1000)
+  for question_id, question, answer, category, difficulty in rows:
+    ids.append(question_id)
+    categories.append(NULL if category is None else category)
+    difficulties.append(NULL if difficulty is None else difficulty)
+    for text in (question, answer):
+      text_heap += (text or '').encode('utf-8')
+      text_offsets.append(len(text_heap))
+
+  positions = range(len(ids))
+  by_category = array('q', sorted(positions,
+                                  key=lambda p: (categories[p], ids[p])))
+  by_difficulty = array('q', sorted(positions,
+                                    key=lambda p: (categories[p],
+                                                   difficulties[p], ids[p])))
+  directory, directory_starts = array('q'), array('q')
+  for index, position in enumerate(by_category):
+    if not directory or directory[-1] != categories[position]:
+      directory.append(categories[position])
+      directory_starts.append(index)
+  directory_starts.append(len(ids))
+
+  category_ids, type_offsets, type_heap = array('q'), array('q', [0]), \
+                                          bytearray()
+  for category in Category.query.order_by(Category.id):
+    category_ids.append(category.id)
+    type_heap += (category.type or '').encode('utf-8')
+    type_offsets.append(len(type_heap))
+
+  sections = [ids, categories, difficulties, text_offsets, text_heap,
+              by_category, by_difficulty, directory, directory_starts,
+              category_ids, type_offsets, type_heap]
+  blobs = [bytes(section) if isinstance(section, bytearray)
+           else section.tobytes() for section in sections]
+  table = []
+  offset = HEADER.size + TABLE.size
+  for blob in blobs:
+    # keep every int64 array 8-byte aligned
+    offset += -offset % 8
+    table += [offset, len(blob)]
+    offset += len(blob)
+
+  directory_name = os.path.dirname(os.path.abspath(path))
+  with tempfile.NamedTemporaryFile(dir=directory_name, delete=False) as file:
+    file.write(HEADER.pack(MAGIC, generation, len(ids), len(category_ids)))
+    file.write(TABLE.pack(*table))
+    for start, blob in zip(table[::2], blobs):
+      file.write(b'\0' * (start - file.tell()))
+      file.write(blob)
+    file.flush()
+    os.fsync(file.fileno())
+  os.replace(file.name, path)
+
+
+class Keys:
+  """
+  Read-only sequence of key(order[i]), to bisect an ordering of positions.
+  """
+
+  def __init__(self, order, key):
+    self.order = order
+    self.key = key
+
+  def __len__(self):
+    return len(self.order)
+
+  def __getitem__(self, index):
+    return self.key(self.order[index])
+
+
+class SnapshotView:
+  """
+  One snapshot file mapped read-only. Its sections are memoryviews on the
+  mapping, so every worker process shares the same pages of the file.
+  """
+
+  def __init__(self, path):
+    with open(path, 'rb') as file:
+      self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, self.generation, self.count, _ = HEADER.unpack_from(self.map)
+    if magic != MAGIC:
+      raise ValueError(f'{path} is not a trivia snapshot')
+    table = TABLE.unpack_from(self.map, HEADER.size)
+    buffer = memoryview(self.map)
+    for index, name in enumerate(SECTIONS):
+      offset, length = table[2 * index], table[2 * index + 1]
+      section = buffer[offset:offset + length]
+      setattr(self, name, section if name.endswith('heap') else section.cast('q'))
+    self.category_types = None
+
+  def row(self, position):
+    """
+    This function returns the question at `position` as a row in
+    QUESTION_COLUMNS order.
+    """
+    offsets = self.text_offsets
+    start, middle, end = offsets[2 * position], offsets[2 * position + 1], \
+                         offsets[2 * position + 2]
+    category = self.categories[position]
+    difficulty = self.difficulties[position]
+    return (self.ids[position],
+            str(self.text_heap[start:middle], 'utf-8'),
+            str(self.text_heap[middle:end], 'utf-8'),
+            None if category == NULL else category,
+            None if difficulty == NULL else difficulty)
+
+  def all_categories(self):
+    """
+    This function returns a {id: type} dict of all categories.
+    """
+    if self.category_types is None:
+      offsets = self.type_offsets
+      self.category_types = {
+        category_id: str(self.type_heap[offsets[index]:offsets[index + 1]],
+                         'utf-8')
+        for index, category_id in enumerate(self.category_ids)}
+    return self.category_types
+
+  def category_range(self, category):
+    index = bisect_left(self.directory, category)
+    if index == len(self.directory) or self.directory[index] != category:
+      return 0, 0
+    return self.directory_starts[index], self.directory_starts[index + 1]
+
+  def window(self, order, lo, hi, key, after, offset, limit, descending):
+    """
+    This function returns up to `limit` rows of `order[lo:hi]`, whose
+    `key` values ascend: those beyond the `after` key if given, otherwise
+    after skipping `offset` rows, walking backwards when `descending`.
+    """
+    keys = Keys(order, key)
+    if descending:
+      end = hi - offset if after is None else bisect_left(keys, after, lo, hi)
+      indexes = range(end - 1, max(lo, end - limit) - 1, -1)
+    else:
+      start = lo + offset if after is None else bisect_right(keys, after, lo, hi)
+      indexes = range(start, min(hi, start + limit))
+    return [self.row(order[index]) for index in indexes]
+
+  def question_page(self, after, offset, limit):
+    """
+    This function returns up to `limit` questions in id order, like
+    GET /questions pages.
+    """
+    ids = self.ids
+    return self.window(range(self.count), 0, self.count,
+                       lambda position: (ids[position],),
+                       after, offset, limit, False)
+
+  def category_page(self, category, min_difficulty, max_difficulty,
+                    sort_by_difficulty, descending, after, offset, limit):
+    """
+    This function returns up to `limit` questions of a category like
+    GET /categories/<id>/questions pages, or None for the combination
+    the orderings can not serve (sort by id within a difficulty range).
+    """
+    ids, difficulties = self.ids, self.difficulties
+    lo, hi = self.category_range(category)
+    filtered = min_difficulty is not None or max_difficulty is not None
+    if not filtered and not sort_by_difficulty:
+      return self.window(self.by_category, lo, hi,
+                         lambda position: (ids[position],),
+                         after, offset, limit, descending)
+    if not sort_by_difficulty and min_difficulty != max_difficulty:
+      return None
+    values = Keys(self.by_difficulty, difficulties.__getitem__)
+    if filtered:
+      # NULL difficulties never match a difficulty filter
+      lo = bisect_left(values, max(min_difficulty or 0, 0), lo, hi)
+      if max_difficulty is not None:
+        hi = bisect_right(values, max_difficulty, lo, hi)
+    elif lo < hi and values[lo] == NULL:
+      # NULL difficulties sort first here but last in the database
+      # ordering (see paginate), so leave them to the database
+      return None
+    if sort_by_difficulty and after is not None and after[0] is None:
+      return None
+    if sort_by_difficulty:
+      key = lambda position: (difficulties[position], ids[position])
+    else:
+      key = lambda position: (ids[position],)
+    return self.window(self.by_difficulty, lo, hi, key,
+                       after, offset, limit, descending)
+
+  def difficulty_counts(self, category):
+    """
+    This function returns the {difficulty: count} of a category.
+    """
+    lo, hi = self.category_range(category)
+    values = Keys(self.by_difficulty, self.difficulties.__getitem__)
+    counts = {}
+    while lo < hi:
+      value = values[lo]
+      end = bisect_right(values, value, lo, hi)
+      if value != NULL:
+        counts[value] = end - lo
+      lo = end
+    return counts
+
+  def draw(self, category, seen):
+    """
+    This function returns a random unseen question of a category (None
+    for all categories) as a row, or None if none is left.
+    """
+    if category is None:
+      question_id = draw_unseen(self.ids, seen)
+    else:
+      lo, hi = self.category_range(category)
+      question_id = draw_unseen(Keys(self.by_category[lo:hi],
+                                     self.ids.__getitem__), seen)
+    if question_id is None:
+      return None
+    return self.row(bisect_left(self.ids, question_id))
+
+
+class GenerationCounter:
+  """
+  A 64-bit counter in a small shared file, mapped by every worker process.
+  Every committed write increments it; snapshots older than it are stale.
+  """
+
+  def __init__(self, path):
+    self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    if os.fstat(self.fd).st_size < 8:
+      os.ftruncate(self.fd, 8)
+    self.map = mmap.mmap(self.fd, 8)
+
+  def value(self):
+    return struct.unpack_from('<Q', self.map)[0]
+
+  def increment(self):
+    fcntl.flock(self.fd, fcntl.LOCK_EX)
+    try:
+      struct.pack_into('<Q', self.map, 0, self.value() + 1)
+    finally:
+      fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+
+class Snapshot:
+  """
+  Serves the question catalog of all worker processes on a host from one
+  memory-mapped snapshot file at SNAPSHOT_PATH. Writes in any worker bump
+  the shared generation. A read that finds the file older than the
+  generation starts a rebuild in a background thread of its worker, so no
+  request waits for it, and the reads of every worker fall back to the
+  database until the file is current again.
+  """
+
+  def __init__(self, app):
+    if fcntl is None:
+      raise RuntimeError('SNAPSHOT_PATH needs a POSIX system')
+    self.app = app
+    self.path = app.config['SNAPSHOT_PATH']
+    self.counter = GenerationCounter(f'{self.path}.generation')
+    self.view = None
+    self.builder = None
+    self.lock = threading.Lock()
+
+  def version_bumped(self, table):
+    self.counter.increment()
+
+  def generation(self):
+    return self.counter.value()
+
+  def current(self):
+    """
+    This function returns the view of the current snapshot, or None while
+    it is being rebuilt.
+    """
+    generation = self.counter.value()
+    view = self.view
+    if view is not None and view.generation == generation:
+      return view
+    if self.building():
+      return None
+    try:
+      view = SnapshotView(self.path)
+    except (FileNotFoundError, ValueError):
+      view = None
+    if view is None or view.generation != generation:
+      self.start_rebuild()
+      return None
+    self.view = view
+    return view
+
+  def building(self):
+    return self.builder is not None and self.builder.is_alive()
+
+  def start_rebuild(self):
+    with self.lock:
+      if not self.building():
+        self.builder = threading.Thread(target=self.rebuild_quietly,
+                                        daemon=True)
+        self.builder.start()
+
+  def rebuild_quietly(self):
+    try:
+      self.rebuild()
+    except Exception:
+      # reads keep falling back to the database, the next one retries
+      self.app.logger.exception('snapshot %s not rebuilt', self.path)
+
+  def rebuild(self):
+    """
+    This function writes the snapshot of the current generation, unless
+    another worker is writing one. Returns whether it wrote it.
+    """
+    with self.app.app_context():
+      try:
+        with open(f'{self.path}.lock', 'a') as lock:
+          try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+          except BlockingIOError:
+            return False
+          build_snapshot(self.path, self.counter.value())
+          return True
+      finally:
+        db.session.remove()
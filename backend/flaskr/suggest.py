@@ -0,0 +1,206 @@
+import heapq
+import sys
+import threading
+from array import array
+from bisect import bisect_left
+from itertools import chain
+
+from models import db, Question, data_versions
+from .changes import replica_reads
+from .search import tokenize
+
+
+class SuggestIndex:
+  """
+  Sorted-array prefix index over the words of question texts, for
+  autocomplete. Answers are left out, suggesting them would give the quiz
+  away. `terms` is the sorted vocabulary and `postings[i]` maps each
+  category to the sorted ids of the questions using `terms[i]`.
+  Built on first use, then kept current by question inserts, updates and
+  deletes (see models.question_listeners); a reset or any other write
+  rebuilds it.
+  """
+
+  def __init__(self):
+    self.version = None
+    self.terms = []
+    self.postings = []
+    self.questions = {}
+    self.memory = (None, None)
+    self.lock = threading.Lock()
+
+  def refresh(self):
+    if self.version == data_versions['questions']:
+      return
+    version = data_versions['questions']
+    with replica_reads():
+      self.load(db.session.query(Question.id, Question.question,
+                                 Question.category)
+                .yield_per(1000), version)
+
+  def load(self, rows, version):
+    """
+    This function rebuilds the index from (id, question, category) rows
+    loaded at the given data version.
+    """
+    words = {}
+    questions = {}
+    for question_id, question, category in rows:
+      questions[question_id] = (question, category)
+      for token in set(tokenize(question)):
+        words.setdefault(token, {}).setdefault(category, []).append(question_id)
+    terms = sorted(words)
+    postings = [{category: array('l', sorted(ids))
+                 for category, ids in words[term].items()}
+                for term in terms]
+    with self.lock:
+      self.terms = terms
+      self.postings = postings
+      self.questions = questions
+      self.version = version
+
+  def questions_changed(self, changes):
+    """
+    This function applies the committed changes of one write,
+    provided the index was current just before it; otherwise, or after a
+    reset, the next refresh rebuilds it.
+    """
+    with self.lock:
+      version = data_versions['questions']
+      if self.version != version - 1:
+        return
+      for action, question in changes:
+        if action == 'insert':
+          self.add(question['id'], question['question'], question['category'])
+        elif action == 'update':
+          self.remove(question['id'])
+          self.add(question['id'], question['question'], question['category'])
+        elif action == 'delete':
+          self.remove(question['id'])
+        else:
+          self.version = None
+          return
+      self.version = version
+
+  def add(self, question_id, question, category):
+    self.questions[question_id] = (question, category)
+    for token in set(tokenize(question)):
+      position = bisect_left(self.terms, token)
+      if position == len(self.terms) or self.terms[position] != token:
+        self.terms.insert(position, token)
+        self.postings.insert(position, {})
+      ids = self.postings[position].setdefault(category, array('l'))
+      ids.insert(bisect_left(ids, question_id), question_id)
+
+  def remove(self, question_id):
+    if question_id not in self.questions:
+      return
+    question, category = self.questions.pop(question_id)
+    for token in set(tokenize(question)):
+      position = bisect_left(self.terms, token)
+      if position == len(self.terms) or self.terms[position] != token:
+        continue
+      ids = self.postings[position].get(category)
+      if ids is None:
+        continue
+      index = bisect_left(ids, question_id)
+      if index < len(ids) and ids[index] == question_id:
+        del ids[index]
+      if not ids:
+        del self.postings[position][category]
+      if not self.postings[position]:
+        del self.terms[position]
+        del self.postings[position]
+
+  def count(self, position, category):
+    postings = self.postings[position]
+    if category is not None:
+      return len(postings.get(category, ()))
+    return sum(len(ids) for ids in postings.values())
+
+  def scoped_ids(self, position, category):
+    postings = self.postings[position]
+    if category is not None:
+      return postings.get(category, ())
+    return chain.from_iterable(postings.values())
+
+  def position(self, term):
+    position = bisect_left(self.terms, term)
+    if position < len(self.terms) and self.terms[position] == term:
+      return position
+    return None
+
+  def suggest(self, prefix, category, limit):
+    """
+    This function returns up to `limit` completions of the last word of
+    `prefix`, most used first, and up to `limit` questions that contain
+    every earlier word of `prefix` and a completion of the last one,
+    as {'id', 'question', 'category'} dicts.
+    """
+    self.refresh()
+    tokens = tokenize(prefix)
+    if not tokens:
+      return [], []
+    *words, last = tokens
+    with self.lock:
+      start = bisect_left(self.terms, last)
+      end = bisect_left(self.terms, last + '\uffff', start)
+      ranked = heapq.nsmallest(limit, ((-self.count(position, category),
+                                        self.terms[position])
+                                       for position in range(start, end)))
+      completions = [term for frequency, term in ranked if frequency < 0]
+
+      # walk the smallest candidate list: the completions, closest first,
+      # or the ids of the rarest earlier word
+      candidates = chain.from_iterable(self.scoped_ids(position, category)
+                                       for position in range(start, end))
+      size = sum(self.count(position, category)
+                 for position in range(start, end))
+      for word in words:
+        position = self.position(word)
+        if position is None:
+          return completions, []
+        if self.count(position, category) < size:
+          candidates = self.scoped_ids(position, category)
+          size = self.count(position, category)
+
+      questions = []
+      seen = set()
+      for question_id in candidates:
+        if question_id in seen:
+          continue
+        seen.add(question_id)
+        question, question_category = self.questions[question_id]
+        if words:
+          question_tokens = set(tokenize(question))
+          if any(word not in question_tokens for word in words) or \
+             not any(token.startswith(last) for token in question_tokens):
+            continue
+        questions.append({'id': question_id,
+                          'question': question,
+                          'category': question_category})
+        if len(questions) == limit:
+          break
+      return completions, questions
+
+  def memory_usage(self):
+    """
+    This function returns the approximate bytes held by the index, or None
+    before it is built. The estimate is recomputed once per data version.
+    """
+    version, size = self.memory
+    if self.version is None:
+      return None
+    if version == self.version:
+      return size
+    with self.lock:
+      size = sys.getsizeof(self.terms) + sys.getsizeof(self.postings) + \
+             sys.getsizeof(self.questions)
+      size += sum(sys.getsizeof(term) for term in self.terms)
+      for postings in self.postings:
+        size += sys.getsizeof(postings)
+        size += sum(sys.getsizeof(ids) for ids in postings.values())
+      size += sum(sys.getsizeof(entry) + sys.getsizeof(entry[0])
+                  for entry in self.questions.values())
+      self.memory = (self.version, size)
+    return size
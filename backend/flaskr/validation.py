@@ -0,0 +1,30 @@
+DIFFICULTIES = [1, 2, 3, 4, 5]
+# questions.id is an integer column, larger ids overflow the drivers
+MAX_ID = 2**31 - 1
+QUESTION_FIELDS = ('question', 'answer', 'category', 'difficulty')
+
+
+def validate_question(data, categories):
+  """
+  This function checks a new question against the rules of POST /questions.
+  Returns the (question, answer, category_id, difficulty) values, or raises
+  ValueError with the message sent back to the client.
+  """
+  if data is None:
+    raise ValueError('Data is empty!')
+  elif not isinstance(data, dict) or \
+       any(field not in data for field in QUESTION_FIELDS):
+    raise ValueError('Invalid data format!')
+  elif not isinstance(data['question'], str) or len(data['question']) < 1:
+    raise ValueError('Question is empty!')
+  elif not isinstance(data['answer'], str) or len(data['answer']) < 1:
+    raise ValueError('Answer is empty!')
+
+  category = categories.resolve(data['category'])
+  if category is None:
+    raise ValueError('Invalid category value!')
+  elif type(data['difficulty']) is not int or \
+       data['difficulty'] not in DIFFICULTIES:
+    raise ValueError('Invalid difficulty value!')
+
+  return data['question'], data['answer'], category, data['difficulty']
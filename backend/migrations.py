@@ -0,0 +1,334 @@
+from datetime import datetime
+
+from sqlalchemy import inspect, text, Integer
+
+from models import db, Question, Category, QuestionChange, QuestionStat, \
+                   content_hash, change_log_rows, CHANGE_LOG_INSERT, STATS_NULL, \
+                   SEARCH_DOCUMENT
+
+'''
+MIGRATIONS
+    ordered (version, description, function) schema steps.
+    every step is repeatable: it checks the current schema and only
+    does the work that is still missing, so an interrupted run can be resumed.
+'''
+MIGRATIONS = []
+
+'''
+MigrationError
+    raised by a step that needs the operator to act first, with what to do
+'''
+class MigrationError(Exception):
+    pass
+
+def migration(version, description):
+    def register(step):
+        MIGRATIONS.append((version, description, step))
+        return step
+    return register
+
+'''
+migrate(engine, batch_size)
+    applies every migration not yet recorded in schema_migrations,
+    returns the (version, description) of the applied steps
+'''
+def migrate(engine, batch_size=1000, log=print):
+    with engine.begin() as connection:
+        connection.execute(text(
+          'CREATE TABLE IF NOT EXISTS schema_migrations ('
+          'version integer PRIMARY KEY, '
+          'description varchar, '
+          'applied_at timestamp)'))
+        applied = {row[0] for row in connection.execute(
+          text('SELECT version FROM schema_migrations'))}
+
+    done = []
+    for version, description, step in sorted(MIGRATIONS, key=lambda m: m[0]):
+        if version in applied:
+            continue
+        log(f'applying {version}: {description}')
+        step(engine, batch_size, log)
+        with engine.begin() as connection:
+            connection.execute(text(
+              'INSERT INTO schema_migrations (version, description, applied_at) '
+              'VALUES (:version, :description, :applied_at)'),
+              {'version': version,
+               'description': description,
+               'applied_at': datetime.utcnow()})
+        done.append((version, description))
+    return done
+
+def _columns(engine, table):
+    return {column['name']: column for column in inspect(engine).get_columns(table)}
+
+def _backfill(engine, statement, batch_size, log):
+    # walk the primary key in ranges, one short transaction per batch,
+    # so the table stays writable while the backfill runs
+    with engine.connect() as connection:
+        last_id = connection.execute(
+          text('SELECT coalesce(max(id), 0) FROM questions')).scalar()
+    start = 0
+    while start < last_id:
+        with engine.begin() as connection:
+            result = connection.execute(text(statement),
+                                        {'start': start,
+                                         'end': start + batch_size})
+        log(f'  backfilled ids {start + 1}-{start + batch_size} '
+            f'({result.rowcount} rows)')
+        start += batch_size
+
+def _create_indexes(engine, indexes, unique=False):
+    connection = engine.connect()
+    concurrently = ''
+    if engine.dialect.name == 'postgresql':
+        # CREATE INDEX CONCURRENTLY can not run inside a transaction block
+        connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+        concurrently = 'CONCURRENTLY '
+    with connection:
+        for name, columns in indexes:
+            connection.execute(text(
+              f'CREATE {"UNIQUE " if unique else ""}INDEX '
+              f'{concurrently}IF NOT EXISTS {name} '
+              f'ON questions ({columns})'))
+
+'''
+0: base schema
+    creates the categories and questions tables of an empty database in
+    their current shape; later steps find nothing left to do on them
+'''
+@migration(0, 'base schema')
+def base_schema(engine, batch_size, log):
+    db.Model.metadata.create_all(engine, tables=[Category.__table__,
+                                                 Question.__table__])
+
+'''
+1: integer category foreign key
+    questions.category used to be a string column. it is backfilled into
+    an integer column and swapped in, dangling categories are cleared,
+    the foreign key is added NOT VALID and validated separately, and the
+    (category, difficulty) and (category, id) indexes are built concurrently.
+    sqlite can not alter a column, so there the table is rebuilt instead;
+    dangling categories are cleared there too.
+'''
+@migration(1, 'integer category foreign key')
+def integer_category_foreign_key(engine, batch_size, log):
+    postgres = engine.dialect.name == 'postgresql'
+    columns = _columns(engine, 'questions')
+
+    if postgres and not isinstance(columns['category']['type'], Integer):
+        numeric = ("CASE WHEN category ~ '^[0-9]+$' "
+                   "THEN category::integer END")
+        if 'category_id' not in columns:
+            with engine.begin() as connection:
+                connection.execute(text(
+                  'ALTER TABLE questions ADD COLUMN category_id integer'))
+        _backfill(engine,
+                  f'UPDATE questions SET category_id = {numeric} '
+                  'WHERE id > :start AND id <= :end',
+                  batch_size, log)
+        with engine.begin() as connection:
+            # block writers only for the catch-up of rows written meanwhile
+            connection.execute(text(
+              'LOCK TABLE questions IN SHARE ROW EXCLUSIVE MODE'))
+            connection.execute(text(
+              f'UPDATE questions SET category_id = {numeric} '
+              'WHERE category_id IS NULL AND category IS NOT NULL'))
+            connection.execute(text('ALTER TABLE questions DROP COLUMN category'))
+            connection.execute(text(
+              'ALTER TABLE questions RENAME COLUMN category_id TO category'))
+    elif not postgres and not isinstance(columns['category']['type'], Integer):
+        # sqlite can not change a column type or add a foreign key in place,
+        # so the table is rebuilt in one transaction
+        with engine.begin() as connection:
+            connection.execute(text(
+              'CREATE TABLE questions_new ('
+              'id INTEGER PRIMARY KEY, '
+              'question VARCHAR, '
+              'answer VARCHAR, '
+              'category INTEGER REFERENCES categories (id), '
+              'difficulty INTEGER)'))
+            connection.execute(text(
+              'INSERT INTO questions_new '
+              'SELECT id, question, answer, '
+              "CASE WHEN category != '' AND category NOT GLOB '*[^0-9]*' "
+              'THEN CAST(category AS INTEGER) END, difficulty '
+              'FROM questions'))
+            connection.execute(text('DROP TABLE questions'))
+            connection.execute(text(
+              'ALTER TABLE questions_new RENAME TO questions'))
+
+    with engine.begin() as connection:
+        connection.execute(text(
+          'UPDATE questions SET category = NULL '
+          'WHERE category IS NOT NULL '
+          'AND category NOT IN (SELECT id FROM categories)'))
+    if postgres:
+        foreign_keys = inspect(engine).get_foreign_keys('questions')
+        if not any(key['referred_table'] == 'categories' for key in foreign_keys):
+            with engine.begin() as connection:
+                connection.execute(text(
+                  'ALTER TABLE questions ADD CONSTRAINT questions_category_fkey '
+                  'FOREIGN KEY (category) REFERENCES categories (id) NOT VALID'))
+            with engine.begin() as connection:
+                connection.execute(text(
+                  'ALTER TABLE questions VALIDATE CONSTRAINT '
+                  'questions_category_fkey'))
+
+    _create_indexes(engine, [
+      ('ix_questions_category_difficulty', 'category, difficulty'),
+      ('ix_questions_category_id', 'category, id'),
+    ])
+
+'''
+remove_duplicate_questions(engine, batch_size, log, dry_run)
+    the offline dedup pass: streams all questions, groups them by
+    content_hash() and deletes every copy but the oldest (lowest id),
+    batch_size ids per transaction. returns the number of duplicates
+'''
+def remove_duplicate_questions(engine, batch_size=1000, log=print,
+                               dry_run=False):
+    first_ids = {}
+    duplicates = []
+    with engine.connect() as connection:
+        rows = connection.execution_options(stream_results=True).execute(
+          text('SELECT id, question, answer FROM questions ORDER BY id'))
+        for question_id, question, answer in rows:
+            first_id = first_ids.setdefault(content_hash(question, answer),
+                                            question_id)
+            if first_id != question_id:
+                log(f'  question {question_id} duplicates {first_id}')
+                duplicates.append(question_id)
+    if dry_run or not duplicates:
+        return len(duplicates)
+    for start in range(0, len(duplicates), batch_size):
+        with engine.begin() as connection:
+            connection.execute(text('DELETE FROM questions WHERE id = :id'),
+                               [{'id': question_id} for question_id
+                                in duplicates[start:start + batch_size]])
+    if engine.has_table('question_changes'):
+        # too many deletes to list, readers of the change feed reload
+        with engine.begin() as connection:
+            connection.execute(text(CHANGE_LOG_INSERT),
+                               change_log_rows([('reset', None)]))
+    if engine.has_table('question_stats'):
+        reconcile_question_stats(engine)
+    log(f'  removed {len(duplicates)} duplicate questions')
+    return len(duplicates)
+
+def _backfill_hashes(engine, batch_size, log):
+    # like _backfill, with hashes computed here rather than in SQL
+    with engine.connect() as connection:
+        last_id = connection.execute(
+          text('SELECT coalesce(max(id), 0) FROM questions')).scalar()
+    start = 0
+    while start < last_id:
+        with engine.begin() as connection:
+            rows = connection.execute(text(
+              'SELECT id, question, answer FROM questions '
+              'WHERE id > :start AND id <= :end AND content_hash IS NULL'),
+              {'start': start, 'end': start + batch_size}).fetchall()
+            if rows:
+                connection.execute(text(
+                  'UPDATE questions SET content_hash = :hash WHERE id = :id'),
+                  [{'id': question_id, 'hash': content_hash(question, answer)}
+                   for question_id, question, answer in rows])
+        log(f'  backfilled ids {start + 1}-{start + batch_size} '
+            f'({len(rows)} rows)')
+        start += batch_size
+
+'''
+2: question content hash
+    adds questions.content_hash, backfills it and builds the unique index
+    that inserts and imports use to skip duplicates. questions are never
+    deleted here: if the backfill reveals duplicates the step fails, and
+    `flask dedup-questions` lists (--dry-run) or removes (--apply) them
+    before the migration is run again
+'''
+@migration(2, 'question content hash')
+def question_content_hash(engine, batch_size, log):
+    if 'content_hash' not in _columns(engine, 'questions'):
+        with engine.begin() as connection:
+            connection.execute(text(
+              'ALTER TABLE questions ADD COLUMN content_hash varchar(64)'))
+    _backfill_hashes(engine, batch_size, log)
+    with engine.connect() as connection:
+        duplicates = connection.execute(text(
+          'SELECT count(content_hash) - count(DISTINCT content_hash) '
+          'FROM questions')).scalar()
+    if duplicates:
+        raise MigrationError(
+          f'{duplicates} duplicate questions block the unique content hash '
+          'index. List them with `flask dedup-questions --dry-run`, remove '
+          'them with `flask dedup-questions --apply` (the oldest copy is '
+          'kept), then run `flask migrate` again.')
+    _create_indexes(engine, [
+      ('ux_questions_content_hash', 'content_hash'),
+    ], unique=True)
+
+'''
+3: question change log
+    creates the question_changes table behind GET /questions/changes
+'''
+@migration(3, 'question change log')
+def question_change_log(engine, batch_size, log):
+    QuestionChange.__table__.create(engine, checkfirst=True)
+
+'''
+reconcile_question_stats(engine)
+    rebuilds question_stats from the questions table in one transaction.
+    on postgresql the counters are locked first: writers that already
+    counted a question commit before the rebuild reads questions, later
+    ones wait for it and count on top of it
+'''
+def reconcile_question_stats(engine):
+    with engine.begin() as connection:
+        if engine.dialect.name == 'postgresql':
+            connection.execute(text(
+              'LOCK TABLE question_stats IN EXCLUSIVE MODE'))
+        connection.execute(text('DELETE FROM question_stats'))
+        connection.execute(text(
+          'INSERT INTO question_stats (category, difficulty, count) '
+          f'SELECT coalesce(category, {STATS_NULL}), '
+          f'coalesce(difficulty, {STATS_NULL}), count(*) FROM questions '
+          f'GROUP BY coalesce(category, {STATS_NULL}), '
+          f'coalesce(difficulty, {STATS_NULL})'))
+
+'''
+4: question statistics
+    creates the question_stats counters behind GET /stats and fills them
+'''
+@migration(4, 'question statistics')
+def question_statistics(engine, batch_size, log):
+    QuestionStat.__table__.create(engine, checkfirst=True)
+    reconcile_question_stats(engine)
+
+'''
+5: full-text search index
+    builds the GIN index over SEARCH_DOCUMENT that PostgresBackend searches
+    with, concurrently so inserts and deletes go on during the build.
+    an invalid index left behind by an interrupted build is dropped and
+    built again. other databases search in process and need no index
+'''
+@migration(5, 'full-text search index')
+def full_text_search_index(engine, batch_size, log):
+    if engine.dialect.name != 'postgresql':
+        return
+    # CREATE INDEX CONCURRENTLY can not run inside a transaction block
+    with engine.connect().execution_options(
+      isolation_level='AUTOCOMMIT') as connection:
+        # the build may take longer than DB_STATEMENT_TIMEOUT allows
+        connection.execute(text('SET statement_timeout = 0'))
+        try:
+            valid = connection.execute(text(
+              'SELECT indisvalid FROM pg_index '
+              "WHERE indexrelid = to_regclass('ix_questions_search')")).scalar()
+            if valid is False:
+                log('  dropping the invalid ix_questions_search')
+                connection.execute(text(
+                  'DROP INDEX CONCURRENTLY ix_questions_search'))
+            connection.execute(text(
+              'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_questions_search '
+              f'ON questions USING GIN (({SEARCH_DOCUMENT}))'))
+        finally:
+            # the connection goes back to the pool
+            connection.execute(text('RESET statement_timeout'))